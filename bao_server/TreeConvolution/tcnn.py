@@ -13,17 +13,30 @@ class BinaryTreeConv(nn.Module):
 
     def forward(self, flat_data):
         trees, idxes = flat_data
-        orig_idxes = idxes
-        idxes = idxes.expand(-1, -1, self.__in_channels).transpose(1, 2)
-        expanded = torch.gather(trees, 2, idxes)
+        batch, _, positions = trees.shape
+        out_channels = self.__out_channels
 
-        results = self.weights(expanded)
+        # rather than gathering every (self, left, right) triple of input
+        # vectors and sliding the kernel over them, project each position
+        # through the self, left and right slices of the kernel at once
+        # (one matmul with the slices stacked), then gather and add the
+        # projections each node needs.
+        kernel = self.weights.weight.permute(2, 0, 1).reshape(3 * out_channels, -1)
+        projected = torch.matmul(kernel, trees).view(batch, 3, out_channels, positions)
 
-        # add a zero vector back on
-        zero_vec = torch.zeros((trees.shape[0], self.__out_channels)).unsqueeze(2)
-        zero_vec = zero_vec.to(results.device)
-        results = torch.cat((zero_vec, results), dim=2)
-        return (results, orig_idxes)
+        triples = idxes.reshape(batch, -1, 3)
+        results = trees.new_zeros((batch, out_channels, triples.shape[1] + 1))
+        out = results[:, :, 1:]
+        for i in range(3):
+            child_idxes = triples[:, :, i].unsqueeze(1).expand(-1, out_channels, -1)
+            gathered = torch.gather(projected[:, i], 2, child_idxes)
+            if i == 0:
+                out.copy_(gathered)
+            else:
+                out.add_(gathered)
+        out.add_(self.weights.bias.view(1, -1, 1))
+
+        return (results, idxes)
 
 class TreeActivation(nn.Module):
     def __init__(self, activation):
@@ -33,15 +46,37 @@ class TreeActivation(nn.Module):
     def forward(self, x):
         return (self.activation(x[0]), x[1])
 
+def _tree_mask(data, idxes):
+    """
+    A (batch x 1 x positions) mask of the positions of `data` that belong
+    to each tree, i.e., position 0 and one per node, but not the padding
+    up to the size of the largest tree in the batch. A node is a triple
+    of tree convolution indexes with a nonzero self index.
+    """
+    num_nodes = (idxes.reshape(idxes.shape[0], -1, 3)[:, :, 0] != 0).sum(dim=1)
+    # positions from the data itself rather than arange, so the mask
+    # follows the batch shape in a traced (frozen) network too.
+    position = torch.cumsum(torch.ones_like(data[:, :1, :]), dim=2) - 1
+    return position <= num_nodes.view(-1, 1, 1)
+
 class TreeLayerNorm(nn.Module):
     def forward(self, x):
+        # normalize each tree over its own positions only, so that its
+        # output does not depend on what else is in the batch.
         data, idxes = x
-        mean = torch.mean(data, dim=(1, 2)).unsqueeze(1).unsqueeze(1)
-        std = torch.std(data, dim=(1, 2)).unsqueeze(1).unsqueeze(1)
-        normd = (data - mean) / (std + 0.00001)
+        mask = _tree_mask(data, idxes).to(data.dtype)
+        count = mask.sum(dim=(1, 2), keepdim=True) * data.shape[1]
+        mean = torch.sum(data * mask, dim=(1, 2), keepdim=True) / count
+        centered = (data - mean) * mask
+        std = torch.sqrt(torch.sum(centered ** 2, dim=(1, 2), keepdim=True)
+                         / (count - 1))
+        # zero the padding, so it carries nothing from this tree
+        normd = (data - mean) / (std + 0.00001) * mask
         return (normd, idxes)
     
 class DynamicPooling(nn.Module):
     def forward(self, x):
-        return torch.max(x[0], dim=2).values
+        data, idxes = x
+        mask = _tree_mask(data, idxes)
+        return torch.max(data.masked_fill(~mask, float("-inf")), dim=2).values
     
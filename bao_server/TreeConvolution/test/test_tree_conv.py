@@ -1,10 +1,21 @@
 import unittest
 import numpy as np
+import torch
 from torch import nn
 
-from util import prepare_trees
+from util import prepare_trees, prepare_flat_trees
 import tcnn
 
+def _flat_trees():
+    # a tree with five nodes and one with three, which gets padded
+    rng = np.random.default_rng(0)
+    return [
+        (rng.normal(size=(5, 4)).astype(np.float32),
+         np.array([2, 0, 4, 0, 0]), np.array([3, 0, 5, 0, 0])),
+        (rng.normal(size=(3, 4)).astype(np.float32),
+         np.array([2, 0, 0]), np.array([3, 0, 0]))
+    ]
+
 class TestTreeConvolution(unittest.TestCase):
 
     def test_example(self):
@@ -63,5 +74,67 @@ class TestTreeConvolution(unittest.TestCase):
         shape = tuple(net(prepared_trees).shape)
         self.assertEqual(shape, (2, 4))
 
+    def test_matches_conv(self):
+        # the layer must compute what gathering the (self, left, right)
+        # triples and sliding its Conv1d over them computes, with the
+        # same weights.
+        data, idxes = prepare_flat_trees(_flat_trees())
+        data.requires_grad_(True)
+
+        torch.manual_seed(0)
+        layer = tcnn.BinaryTreeConv(4, 8)
+
+        def reference(data):
+            expanded = torch.gather(
+                data, 2, idxes.expand(-1, -1, 4).transpose(1, 2))
+            res = layer.weights(expanded)
+            return torch.cat((torch.zeros(2, 8, 1), res), dim=2)
+
+        expected = reference(data)
+        expected.sum().backward()
+        expected_grads = [data.grad.clone(), layer.weights.weight.grad.clone()]
+        data.grad = None
+        layer.zero_grad()
+
+        actual, actual_idxes = layer((data, idxes))
+        actual.sum().backward()
+
+        self.assertIs(actual_idxes, idxes)
+        self.assertEqual(tuple(actual.shape), (2, 8, 6))
+        self.assertTrue(torch.all(actual[:, :, 0] == 0))
+        self.assertTrue(torch.allclose(actual, expected, atol=1e-5))
+        self.assertTrue(torch.allclose(data.grad, expected_grads[0], atol=1e-5))
+        self.assertTrue(torch.allclose(layer.weights.weight.grad,
+                                       expected_grads[1], atol=1e-5))
+
+    def test_padding_invariance(self):
+        # a tree must get the same output whether it is alone or padded
+        # to the size of a larger tree in the same batch.
+        torch.manual_seed(0)
+        net = nn.Sequential(
+            tcnn.BinaryTreeConv(4, 8),
+            tcnn.TreeLayerNorm(),
+            tcnn.TreeActivation(nn.LeakyReLU()),
+            tcnn.BinaryTreeConv(8, 4),
+            tcnn.TreeLayerNorm(),
+            tcnn.DynamicPooling()
+        )
+
+        large, small = _flat_trees()
+        batched = net(prepare_flat_trees([large, small]))
+        self.assertTrue(torch.allclose(batched[0], net(prepare_flat_trees([large]))[0],
+                                       atol=1e-5))
+        self.assertTrue(torch.allclose(batched[1], net(prepare_flat_trees([small]))[0],
+                                       atol=1e-5))
+
+    def test_layer_norm_unpadded(self):
+        # without padding, the norm is over the whole tree, as before
+        data, idxes = prepare_flat_trees(_flat_trees()[:1])
+        data = tcnn.BinaryTreeConv(4, 8)((data, idxes))[0]
+        normd = tcnn.TreeLayerNorm()((data, idxes))[0]
+        expected = (data - torch.mean(data)) / (torch.std(data) + 0.00001)
+        self.assertTrue(torch.allclose(normd, expected, atol=1e-5))
+
+
 if __name__ == '__main__':
     unittest.main()
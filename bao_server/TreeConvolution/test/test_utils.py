@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from util import prepare_trees, TreeConvolutionError
+from util import prepare_trees, prepare_flat_trees, PackedTrees, TreeConvolutionError
 
 
 class TestUtils(unittest.TestCase):
@@ -46,6 +46,78 @@ class TestUtils(unittest.TestCase):
         prepared_trees = prepare_trees(trees, transformer, left_child, right_child)
         self.assertEqual(len(prepared_trees), 2)
 
+        flat_trees, indexes = prepared_trees
+        # batch x channels x (largest tree + the zero vector)
+        self.assertEqual(tuple(flat_trees.shape), (2, 2, 8))
+        np.testing.assert_array_equal(
+            flat_trees[0].numpy(),
+            np.array([[0, 0, 1, 0, -1, -3, 2, 1],
+                      [0, 1, 2, 1, 0, 0, 3, 2]]))
+        np.testing.assert_array_equal(
+            flat_trees[1].numpy(),
+            np.array([[0, 16, 0, 5, 2, 2, 0, 0],
+                      [0, 3, 1, 3, 6, 9, 0, 0]]))
+
+        # (self, left, right) preorder indexes per node, zero-padded
+        self.assertEqual(tuple(indexes.shape), (2, 21, 1))
+        np.testing.assert_array_equal(
+            indexes[0, :, 0].numpy(),
+            np.array([1, 2, 5, 2, 3, 4, 3, 0, 0, 4, 0, 0,
+                      5, 6, 7, 6, 0, 0, 7, 0, 0]))
+        np.testing.assert_array_equal(
+            indexes[1, :, 0].numpy(),
+            np.array([1, 2, 5, 2, 3, 4, 3, 0, 0, 4, 0, 0,
+                      5, 0, 0, 0, 0, 0, 0, 0, 0]))
+
+    def test_prepare_flat(self):
+        # the example trees, flattened by hand in preorder
+        tree1 = (
+            np.array([[0, 1], [1, 2], [0, 1], [-1, 0], [-3, 0], [2, 3], [1, 2]]),
+            np.array([2, 3, 0, 0, 6, 0, 0]),
+            np.array([5, 4, 0, 0, 7, 0, 0])
+        )
+
+        tree2 = (
+            np.array([[16, 3], [0, 1], [5, 3], [2, 6], [2, 9]]),
+            np.array([2, 3, 0, 0, 0]),
+            np.array([5, 4, 0, 0, 0])
+        )
+
+        flat_trees, indexes = prepare_flat_trees([tree1, tree2])
+        self.assertEqual(tuple(flat_trees.shape), (2, 2, 8))
+        self.assertEqual(tuple(indexes.shape), (2, 21, 1))
+        np.testing.assert_array_equal(
+            indexes[1, :, 0].numpy(),
+            np.array([1, 2, 5, 2, 3, 4, 3, 0, 0, 4, 0, 0,
+                      5, 0, 0, 0, 0, 0, 0, 0, 0]))
+        np.testing.assert_array_equal(
+            flat_trees[0].numpy(),
+            np.array([[0, 0, 1, 0, -1, -3, 2, 1],
+                      [0, 1, 2, 1, 0, 0, 3, 2]]))
+
+    def test_packed_batch(self):
+        # any batch of packed trees matches preparing it directly
+        rng = np.random.default_rng(0)
+        trees = [
+            (rng.normal(size=(5, 3)).astype(np.float32),
+             np.array([2, 0, 4, 0, 0]), np.array([3, 0, 5, 0, 0])),
+            (rng.normal(size=(1, 3)).astype(np.float32),
+             np.array([0]), np.array([0])),
+            (rng.normal(size=(3, 3)).astype(np.float32),
+             np.array([2, 0, 0]), np.array([3, 0, 0]))
+        ]
+
+        packed = PackedTrees(trees)
+        self.assertEqual(len(packed), 3)
+        for idxs in ([0, 1, 2], [2, 1], [1], [2, 0, 2]):
+            flat_trees, indexes = packed.batch(idxs)
+            expected_trees, expected_indexes = prepare_flat_trees(
+                [trees[i] for i in idxs])
+            np.testing.assert_array_equal(flat_trees.numpy(),
+                                          expected_trees.numpy())
+            np.testing.assert_array_equal(indexes.numpy(),
+                                          expected_indexes.numpy())
+
     def test_raises_on_malformed(self):
                 # simple smoke test from the example file
         tree1 = (
@@ -5,20 +5,7 @@ import torch
 class TreeConvolutionError(Exception):
     pass
 
-def _is_leaf(x, left_child, right_child):
-    has_left = left_child(x) is not None
-    has_right = right_child(x) is not None
-    
-    if has_left != has_right:
-        raise TreeConvolutionError(
-            "All nodes must have both a left and a right child or no children"
-        )
-
-    return not has_left
-
-def _flatten(root, transformer, left_child, right_child):
-    """ turns a tree into a flattened vector, preorder """
-
+def _check_callables(transformer, left_child, right_child):
     if not callable(transformer):
         raise TreeConvolutionError(
             "Transformer must be a function mapping a tree node to a vector"
@@ -30,128 +17,185 @@ def _flatten(root, transformer, left_child, right_child):
             + "tree node to its child, or None"
         )
 
-        
-    accum = []
+def _flatten(root, transformer, left_child, right_child):
+    """
+    Walks a tree (iteratively) in preorder. Returns the list of node
+    feature vectors and a flat list of tree convolution indexes, three
+    per node: its own index, its left child's and its right child's.
+    The node at preorder position i has index i + 1; index 0 refers to
+    the zero vector that stands in for the children of leaves.
+    """
+    vecs = []
+    conv_idxes = []
+
+    # each entry is a node and the slot in conv_idxes of its parent
+    # that should hold its index.
+    stack = [(root, None)]
+    while stack:
+        node, parent_slot = stack.pop()
+        my_idx = len(vecs) + 1
+        if parent_slot is not None:
+            conv_idxes[parent_slot] = my_idx
+
+        vecs.append(transformer(node))
+        my_slot = len(conv_idxes)
+        conv_idxes.extend((my_idx, 0, 0))
+
+        left = left_child(node)
+        right = right_child(node)
+        if (left is None) != (right is None):
+            raise TreeConvolutionError(
+                "All nodes must have both a left and a right child or no children"
+            )
+
+        if left is not None:
+            # push the right child first so the whole left subtree is
+            # visited before it.
+            stack.append((right, my_slot + 2))
+            stack.append((left, my_slot + 1))
 
-    def recurse(x):
-        if _is_leaf(x, left_child, right_child):
-            accum.append(transformer(x))
-            return
+    return vecs, conv_idxes
 
-        accum.append(transformer(x))
-        recurse(left_child(x))
-        recurse(right_child(x))
+def prepare_trees(trees, transformer, left_child, right_child, cuda=False):
+    """
+    Flattens a batch of trees into the input of a `BinaryTreeConv`: a
+    (batch x channels x max nodes + 1) tensor of node features, where
+    position 0 of each tree is a zero vector and the remaining positions
+    hold the nodes in preorder, and a (batch x 3 * max nodes x 1) tensor
+    of tree convolution indexes. Trees smaller than the largest one are
+    padded with zeros.
+    """
+    _check_callables(transformer, left_child, right_child)
 
-    recurse(root)
+    flat = [_flatten(x, transformer, left_child, right_child) for x in trees]
+    max_nodes = max(len(vecs) for vecs, _ in flat)
 
     try:
-        accum = [np.zeros(accum[0].shape)] + accum
-    except:
+        channels = flat[0][0][0].shape[0]
+    except (AttributeError, IndexError):
         raise TreeConvolutionError(
             "Output of transformer must have a .shape (e.g., numpy array)"
         )
-    
-    return np.array(accum)
 
-def _preorder_indexes(root, left_child, right_child, idx=1):
-    """ transforms a tree into a tree of preorder indexes """
-    
-    if not callable(left_child) or not callable(right_child):
-        raise TreeConvolutionError(
-            "left_child and right_child must be a function mapping a " +
-            "tree node to its child, or None"
-        )
+    flat_trees = np.zeros((len(trees), channels, max_nodes + 1),
+                          dtype=np.float32)
+    indexes = np.zeros((len(trees), 3 * max_nodes, 1), dtype=np.int64)
 
+    for i, (vecs, conv_idxes) in enumerate(flat):
+        try:
+            vecs = np.array(vecs, dtype=np.float32)
+        except ValueError:
+            vecs = None
 
-    if _is_leaf(root, left_child, right_child):
-        # leaf
-        return idx
-
-    def rightmost(tree):
-        if isinstance(tree, tuple):
-            return rightmost(tree[2])
-        return tree
-    
-    left_subtree = _preorder_indexes(left_child(root), left_child, right_child,
-                                     idx=idx+1)
-    
-    max_index_in_left = rightmost(left_subtree)
-    right_subtree = _preorder_indexes(right_child(root), left_child, right_child,
-                                      idx=max_index_in_left + 1)
-
-    return (idx, left_subtree, right_subtree)
-    
-def _tree_conv_indexes(root, left_child, right_child):
-    """ 
-    Create indexes that, when used as indexes into the output of `flatten`,
-    create an array such that a stride-3 1D convolution is the same as a
-    tree convolution.
-    """
-    
-    if not callable(left_child) or not callable(right_child):
-        raise TreeConvolutionError(
-            "left_child and right_child must be a function mapping a "
-            + "tree node to its child, or None"
-        )
-    
-    index_tree = _preorder_indexes(root, left_child, right_child)
-
-    def recurse(root):
-        if isinstance(root, tuple):
-            my_id = root[0]
-            left_id = root[1][0] if isinstance(root[1], tuple) else root[1]
-            right_id = root[2][0] if isinstance(root[2], tuple) else root[2]
-            yield [my_id, left_id, right_id]
-                                           
-            yield from recurse(root[1])
-            yield from recurse(root[2])
-        else:
-            yield [root, 0, 0]
-
-    return np.array(list(recurse(index_tree))).flatten().reshape(-1, 1)
-
-def _pad_and_combine(x):
-    assert len(x) >= 1
-    assert len(x[0].shape) == 2
-
-    for itm in x:
-        if itm.dtype == np.dtype("object"):
+        if vecs is None or vecs.shape != (len(conv_idxes) // 3, channels):
             raise TreeConvolutionError(
                 "Transformer outputs could not be unified into an array. "
                 + "Are they all the same size?"
             )
-    
-    second_dim = x[0].shape[1]
-    for itm in x[1:]:
-        assert itm.shape[1] == second_dim
-
-    max_first_dim = max(arr.shape[0] for arr in x)
-
-    vecs = []
-    for arr in x:
-        padded = np.zeros((max_first_dim, second_dim))
-        padded[0:arr.shape[0]] = arr
-        vecs.append(padded)
 
-    return np.array(vecs)
+        flat_trees[i, :, 1:vecs.shape[0] + 1] = vecs.T
+        indexes[i, :len(conv_idxes), 0] = conv_idxes
 
-def prepare_trees(trees, transformer, left_child, right_child, cuda=False):
-    flat_trees = [_flatten(x, transformer, left_child, right_child) for x in trees]
-    flat_trees = _pad_and_combine(flat_trees)
-    flat_trees = torch.Tensor(flat_trees)
+    # flat trees is batch x channels x max tree nodes
+    flat_trees = torch.from_numpy(flat_trees)
+    indexes = torch.from_numpy(indexes)
 
-    # flat trees is now batch x max tree nodes x channels
-    flat_trees = flat_trees.transpose(1, 2)
     if cuda:
         flat_trees = flat_trees.cuda()
+        indexes = indexes.cuda()
 
-    indexes = [_tree_conv_indexes(x, left_child, right_child) for x in trees]
-    indexes = _pad_and_combine(indexes)
-    indexes = torch.Tensor(indexes).long()
+    return (flat_trees, indexes)
+
+def prepare_flat_trees(trees, cuda=False):
+    """
+    Like `prepare_trees`, but for trees that are already flattened into
+    arrays. Each tree is a tuple of a (nodes x channels) feature matrix
+    with the nodes in preorder, and two arrays holding, for each node,
+    the preorder position + 1 of its left and right child (0 for leaves).
+    """
+    max_nodes = max(tree[0].shape[0] for tree in trees)
+    channels = trees[0][0].shape[1]
+
+    flat_trees = np.zeros((len(trees), channels, max_nodes + 1),
+                          dtype=np.float32)
+    indexes = np.zeros((len(trees), max_nodes, 3), dtype=np.int64)
+
+    for i, (features, left, right) in enumerate(trees):
+        n = features.shape[0]
+        if features.shape[1] != channels:
+            raise TreeConvolutionError(
+                "All trees must have the same number of channels"
+            )
+
+        flat_trees[i, :, 1:n + 1] = features.T
+        indexes[i, :n, 0] = np.arange(1, n + 1)
+        indexes[i, :n, 1] = left
+        indexes[i, :n, 2] = right
+
+    flat_trees = torch.from_numpy(flat_trees)
+    indexes = torch.from_numpy(indexes.reshape(len(trees), 3 * max_nodes, 1))
 
     if cuda:
+        flat_trees = flat_trees.cuda()
         indexes = indexes.cuda()
 
     return (flat_trees, indexes)
-                    
 
+class PackedTrees:
+    """
+    Flattened trees (as taken by `prepare_flat_trees`) packed once into
+    tensors, so that any batch of them can be prepared by indexing alone:
+    the features of all nodes concatenated into one (nodes x channels)
+    tensor, with each tree's nodes starting at `offsets[i]`, and each
+    node's (self, left, right) tree convolution indexes, relative to its
+    own tree, in a (nodes x 3) tensor.
+    """
+    def __init__(self, trees):
+        self.sizes = torch.tensor([tree[0].shape[0] for tree in trees])
+        self.offsets = torch.cat([torch.zeros(1, dtype=torch.int64),
+                                  torch.cumsum(self.sizes, dim=0)])
+
+        channels = trees[0][0].shape[1]
+        if any(tree[0].shape[1] != channels for tree in trees):
+            raise TreeConvolutionError(
+                "All trees must have the same number of channels"
+            )
+
+        self.features = torch.from_numpy(
+            np.concatenate([tree[0] for tree in trees]).astype(np.float32))
+        self.indexes = torch.from_numpy(np.stack([
+            np.concatenate([np.arange(1, tree[0].shape[0] + 1) for tree in trees]),
+            np.concatenate([tree[1] for tree in trees]),
+            np.concatenate([tree[2] for tree in trees])
+        ], axis=1).astype(np.int64))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def batch(self, idxs, cuda=False):
+        """
+        The trees at positions `idxs`, prepared as by `prepare_flat_trees`.
+        """
+        idxs = torch.as_tensor(idxs)
+        sizes = self.sizes[idxs]
+        max_nodes = int(sizes.max())
+
+        # the node behind each (tree, position) of the batch, and whether
+        # the position is a node at all or padding
+        position = torch.arange(max_nodes)
+        is_node = position.unsqueeze(0) < sizes.unsqueeze(1)
+        nodes = torch.where(is_node,
+                            self.offsets[idxs].unsqueeze(1) + position,
+                            torch.zeros((), dtype=torch.int64))
+
+        features = self.features[nodes] * is_node.unsqueeze(2)
+        flat_trees = torch.zeros((len(idxs), self.features.shape[1], max_nodes + 1))
+        flat_trees[:, :, 1:] = features.transpose(1, 2)
+        indexes = (self.indexes[nodes] * is_node.unsqueeze(2)).reshape(
+            len(idxs), 3 * max_nodes, 1)
+
+        if cuda:
+            flat_trees = flat_trees.cuda()
+            indexes = indexes.cuda()
+
+        return (flat_trees, indexes)
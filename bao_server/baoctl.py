@@ -10,11 +10,56 @@ def __connect():
     s.connect(("195.251.63.231", 9381))
     return s
 
-def send_model_load(path):
+def send_model_load(path, wait=False):
+    """
+    Have the Bao server load the model at `path`. If `wait` is set, block
+    until the server is done loading it, and return whether the model
+    was accepted.
+    """
     with __connect() as s:
-        s.sendall(__json_bytes({"type": "load model"}))
+        s.sendall(__json_bytes({"type": "load model", "wait": wait}))
         s.sendall(__json_bytes({"path": path}))
         s.sendall(__json_bytes({"final": True}))
+        if not wait:
+            return None
+
+        s.shutdown(socket.SHUT_WR)
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())["accepted"]
+
+def __request_json(message_type, **header):
+    with __connect() as s:
+        s.sendall(__json_bytes(dict(header, type=message_type)))
+        s.sendall(__json_bytes({"final": True}))
+        s.shutdown(socket.SHUT_WR)
+
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())
+
+def request_cache_stats():
+    return __request_json("cache stats")
+
+def flush_rewards():
+    """
+    Wait until every reward the Bao server has received is in bao.db.
+    """
+    return __request_json("flush rewards")
+
+def flush_rewards_for_training():
+    """
+    Have the Bao server write the rewards it still holds, so training
+    sees them. Without a running server, there are none to wait for.
+    """
+    try:
+        flush_rewards()
+    except OSError as e:
+        print("Could not reach the Bao server to flush its rewards, "
+              + "training on what is in bao.db:", e)
+
+def request_embedding(pid=None):
+    if pid is None:
+        return __request_json("get embedding")
+    return __request_json("get embedding", pid=pid)
 
 
 if __name__ == "__main__":
@@ -27,6 +72,9 @@ if __name__ == "__main__":
                         help="Train a Bao model and save it")
     parser.add_argument("--retrain", action="store_true",
                         help="Force the Bao server to train a model and load it")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="With --retrain, fine-tune the current model on new experience "
+                        + "instead of training from scratch (when possible)")
     parser.add_argument("--test-connection", action="store_true",
                         help="Test the connection from the Bao server to the PostgreSQL instance.")
     parser.add_argument("--add-test-query", metavar="PATH",
@@ -35,13 +83,21 @@ if __name__ == "__main__":
                         help="Print out information about the Bao server.")
     parser.add_argument("--experiment", metavar="SECONDS", type=int,
                         help="Conduct experiments on test queries for (up to) SECONDS seconds.")
+    parser.add_argument("--cache-stats", action="store_true",
+                        help="Print the plan cache hit/miss counters of the Bao server.")
+    parser.add_argument("--migrate-plans", metavar="ENCODING", choices=["json", "zlib"],
+                        help="Convert the plans stored in bao.db to ENCODING (json or zlib).")
     
     args = parser.parse_args()
 
     if args.train:
         import train
+        from config import read_config
         print("Training Bao model from collected experience")
-        train.train_and_save_model(args.train)
+        flush_rewards_for_training()
+        train.train_and_save_model(
+            args.train,
+            batch_size=int(read_config().get("ExperienceBatchSize", 1000)))
         exit(0)
 
     if args.load:
@@ -51,16 +107,23 @@ if __name__ == "__main__":
         reg.load(args.load)
         
         print("Model loaded. Sending message to Bao server...")
-        send_model_load(args.load)
-        print("Message sent to server.")
+        if send_model_load(args.load, wait=True):
+            print("The Bao server accepted the model.")
+        else:
+            print("The Bao server kept its current model.")
         exit(0)
 
     if args.retrain:
         import train
+        from config import read_config
         from constants import DEFAULT_MODEL_PATH, OLD_MODEL_PATH, TMP_MODEL_PATH
+        flush_rewards_for_training()
         train.train_and_swap(DEFAULT_MODEL_PATH, OLD_MODEL_PATH, TMP_MODEL_PATH,
-                             verbose=True)
-        send_model_load(DEFAULT_MODEL_PATH)
+                             verbose=True, warm_start=args.warm_start,
+                             batch_size=int(read_config().get("ExperienceBatchSize", 1000)))
+        # wait for the swap, so the queries run next use the new model
+        if not send_model_load(DEFAULT_MODEL_PATH, wait=True):
+            print("The Bao server kept its current model.")
         exit(0)
 
     if args.test_connection:
@@ -101,5 +164,25 @@ if __name__ == "__main__":
             
         exit(0)
 
+    if args.cache_stats:
+        info = request_cache_stats()
+
+        max_key_length = max(len(x) for x in info.keys())
+
+        for k, v in info.items():
+            print(k.ljust(max_key_length), ":", v)
+
+        exit(0)
+
 
     
+
+    if args.migrate_plans:
+        import os
+        import storage
+        before = os.path.getsize(storage.DB_PATH)
+        migrated = storage.migrate_plans(args.migrate_plans)
+        after = os.path.getsize(storage.DB_PATH)
+        print(f"Converted {migrated} plan(s) to {args.migrate_plans}, "
+              + f"bao.db went from {before} to {after} bytes.")
+        exit(0)
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from urllib.request import pathname2url
+
+# Micro-benchmarks for the pieces of the Bao server that sit on the query
+# path. Each benchmark runs in a scratch directory, so it never touches
+# the real bao.db.
+
+SAMPLE_PLAN = {
+    "Plan": {
+        "Node Type": "Hash Join",
+        "Total Cost": 1234.5,
+        "Plan Rows": 1000,
+        "Plans": [
+            {"Node Type": "Seq Scan", "Relation Name": "title",
+             "Total Cost": 500.0, "Plan Rows": 10000},
+            {"Node Type": "Index Scan", "Relation Name": "cast_info",
+             "Index Name": "cast_info_pkey", "Total Cost": 700.0,
+             "Plan Rows": 100}
+        ]
+    },
+    "Buffers": {"title": 120, "cast_info": 4096, "cast_info_pkey": 64}
+}
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def report(name, seconds):
+    print(f"{name:<24} {seconds * 1e6:12.1f} us/call")
+
+def bench_storage(args):
+    import storage
+
+    # fill the database first, so reads see a realistic table.
+    for i in range(args.rows):
+        storage.record_reward(SAMPLE_PLAN, float(i), i % 16)
+
+    report("last_reward_from_pid",
+           time_per_call(lambda: storage.last_reward_from_pid(1), args.repeat))
+    report(f"experience ({args.rows} rows)",
+           time_per_call(storage.experience, max(1, args.repeat // 100)))
+    report("record_reward",
+           time_per_call(lambda: storage.record_reward(SAMPLE_PLAN, 1.0, 1),
+                         args.repeat))
+
+def bench_inference(args):
+    import joblib
+    import torch
+    import model
+    import net
+    from storage import _decode_plan
+
+    # read-only, so the server's schema setup and retention never run
+    # against the database being benchmarked.
+    conn = sqlite3.connect(f"file:{pathname2url(args.db)}?mode=ro", uri=True)
+    try:
+        c = conn.execute("SELECT plan FROM experience ORDER BY RANDOM() LIMIT ?",
+                         (args.arms,))
+        plans = [json.loads(_decode_plan(x[0])) for x in c.fetchall()]
+    finally:
+        conn.close()
+    if not plans:
+        print("No experience in", args.db, "to benchmark with.")
+        return
+
+    with open(model._x_transform_path(args.model), "rb") as f:
+        trees = joblib.load(f).transform(plans)
+    bao_net = net.BaoNet(trees[0].features.shape[1])
+    bao_net.load_state_dict(torch.load(model._nn_path(args.model)))
+    bao_net.eval()
+
+    print(f"Per query of {len(plans)} arm(s), without featurization:")
+    report("autograd + detach",
+           time_per_call(lambda: bao_net(trees).cpu().detach().numpy(), args.repeat))
+    report("inference_mode",
+           time_per_call(lambda: bao_net.predict(trees).cpu().numpy(), args.repeat))
+    bao_net.freeze()
+    report("frozen TorchScript",
+           time_per_call(lambda: bao_net.predict(trees).cpu().numpy(), args.repeat))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Bao server micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    storage_parser = subparsers.add_parser(
+        "storage", help="Per-call overhead of the experience storage functions.")
+    storage_parser.add_argument("--rows", type=int, default=1000,
+                                help="Experience rows to create before timing reads.")
+    storage_parser.add_argument("--repeat", type=int, default=1000,
+                                help="Calls to time per function.")
+    storage_parser.set_defaults(run=bench_storage)
+
+    inference_parser = subparsers.add_parser(
+        "inference", help="Per-query latency of the model's forward pass.")
+    inference_parser.add_argument("model", help="Path of a saved Bao model.")
+    inference_parser.add_argument("--db", default="bao.db",
+                                  help="Database to sample the arms of a query from.")
+    inference_parser.add_argument("--arms", type=int, default=5,
+                                  help="Plans per query.")
+    inference_parser.add_argument("--repeat", type=int, default=1000,
+                                  help="Queries to time per variant.")
+    inference_parser.set_defaults(run=bench_inference)
+
+    args = parser.parse_args()
+    # paths are relative to where the benchmark was started
+    for path_arg in ("model", "db"):
+        if hasattr(args, path_arg):
+            setattr(args, path_arg, os.path.abspath(getattr(args, path_arg)))
+
+    os.chdir(tempfile.mkdtemp(prefix="bao-benchmark-"))
+    args.run(args)
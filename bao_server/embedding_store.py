@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import deque
+
+class EmbeddingStore:
+    """
+    A bounded, in-memory ring buffer of the embeddings computed during
+    plan selection, tagged with the PID of the PostgreSQL backend that
+    planned the query (if the extension sent one).
+    """
+    def __init__(self, capacity):
+        self.__entries = deque(maxlen=capacity)
+        self.__lock = threading.Lock()
+
+    def add(self, pid, embedding):
+        with self.__lock:
+            self.__entries.append((pid, time.time(), embedding))
+
+    def take(self, pid=None):
+        """
+        Remove and return the most recent embedding for backend `pid`, so
+        that a later query on the same backend never sees a stale one. If
+        `pid` is None, return the most recent embedding of any backend
+        without removing it. Returns None if there is no such embedding.
+        """
+        with self.__lock:
+            if pid is None:
+                if not self.__entries:
+                    return None
+                entry = self.__entries[-1]
+            else:
+                for i in range(len(self.__entries) - 1, -1, -1):
+                    if self.__entries[i][0] == pid:
+                        entry = self.__entries[i]
+                        del self.__entries[i]
+                        break
+                else:
+                    return None
+
+        entry_pid, timestamp, embedding = entry
+        return {
+            "pid": entry_pid,
+            "embedding": embedding.tolist(),
+            "timestamp": timestamp
+        }
@@ -1,3 +1,4 @@
+from collections import namedtuple
 import numpy as np
 
 JOIN_TYPES = ["Nested Loop", "Hash Join", "Merge Join"]
@@ -6,6 +7,11 @@ LEAF_TYPES = ["Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Index Scan"]
 ALL_TYPES = JOIN_TYPES + LEAF_TYPES
 
 
+# A featurized plan tree: a (nodes x channels) feature matrix with the
+# nodes in preorder, and for each node the preorder position + 1 of its
+# left and right child (0 for scans, which have no children).
+FeatureTree = namedtuple("FeatureTree", ["features", "left", "right"])
+
 class TreeBuilderError(Exception):
     def __init__(self, msg):
         self.__msg = msg
@@ -20,60 +26,117 @@ class TreeBuilder:
     def __init__(self, stats_extractor, relations):
         self.__stats = stats_extractor
         self.__relations = sorted(relations, key=lambda x: len(x), reverse=True)
-
-    def __relation_name(self, node):
-        if "Relation Name" in node:
-            return node["Relation Name"]
-
-        if node["Node Type"] == "Bitmap Index Scan":
-            # find the first (longest) relation name that appears in the index name
-            name_key = "Index Name" if "Index Name" in node else "Relation Name"
-            if name_key not in node:
-                print(node)
-                raise TreeBuilderError("Bitmap operator did not have an index name or a relation name")
-            for rel in self.__relations:
-                if rel in node[name_key]:
-                    return rel
-
+        self.__index_relations = {}
+
+    def __getstate__(self):
+        # the trie is cheap to rebuild, so keep it out of saved models
+        state = self.__dict__.copy()
+        state.pop("_TreeBuilder__trie", None)
+        return state
+
+    def stats_extractor(self):
+        return self.__stats
+
+    def relations(self):
+        return set(self.__relations)
+
+    def resolve_index_names(self, index_names):
+        """ Resolve (and remember) the relation of each index name. """
+        for index_name in index_names:
+            self.__relation_name(index_name)
+
+    def __build_trie(self):
+        # a trie of the relation names; a node is a dict of children, with
+        # the rank (position in __relations) of the name ending there under
+        # the None key.
+        trie = {}
+        for rank, rel in enumerate(self.__relations):
+            node = trie
+            for ch in rel:
+                node = node.setdefault(ch, {})
+            node[None] = rank
+        self.__trie = trie
+        return trie
+
+    def __relation_name(self, index_name):
+        # models saved before the lookup table existed do not have it
+        index_relations = self.__dict__.setdefault("_TreeBuilder__index_relations", {})
+        if index_name in index_relations:
+            rel = index_relations[index_name]
+        else:
+            rel = self.__match_relation(index_name)
+            index_relations[index_name] = rel
+
+        if rel is None:
             raise TreeBuilderError("Could not find relation name for bitmap index scan")
-
-        raise TreeBuilderError("Cannot extract relation type from node")
-                
-    def __featurize_join(self, node):
-        assert is_join(node)
-        arr = np.zeros(len(ALL_TYPES))
-        arr[ALL_TYPES.index(node["Node Type"])] = 1
-        return np.concatenate((arr, self.__stats(node)))
-
-    def __featurize_scan(self, node):
-        assert is_scan(node)
-        arr = np.zeros(len(ALL_TYPES))
-        arr[ALL_TYPES.index(node["Node Type"])] = 1
-        return (np.concatenate((arr, self.__stats(node))),
-                self.__relation_name(node))
+        return rel
+
+    def __match_relation(self, index_name):
+        # find the first (longest) relation name that appears in the index
+        # name, by walking the trie from every position of the index name.
+        trie = self.__dict__.get("_TreeBuilder__trie") or self.__build_trie()
+        best = None
+        for start in range(len(index_name)):
+            node = trie
+            for ch in index_name[start:]:
+                node = node.get(ch)
+                if node is None:
+                    break
+                rank = node.get(None)
+                if rank is not None and (best is None or rank < best):
+                    best = rank
+
+        return None if best is None else self.__relations[best]
+
+    def raw_to_feature_tree(self, raw):
+        return self.raws_to_feature_trees([raw])[0]
+
+    def raws_to_feature_trees(self, raws):
+        """
+        Featurize many RawPlans at once: the statistics of all of their
+        nodes are normalized together, into one feature matrix that the
+        returned FeatureTrees are slices of.
+        """
+        # bitmap index scans must belong to a relation we know about
+        for raw in raws:
+            self.resolve_index_names(raw.bitmap_index_names)
+
+        sizes = [len(raw.node_types) for raw in raws]
+        offsets = np.zeros(len(raws) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        num_nodes = offsets[-1]
+
+        num_types = len(ALL_TYPES)
+        features = np.zeros((num_nodes, num_types + self.__stats.num_fields()),
+                            dtype=np.float32)
+        if num_nodes:
+            node_types = np.concatenate([raw.node_types for raw in raws])
+            features[np.arange(num_nodes), node_types] = 1
+            self.__stats.transform_columns(
+                np.concatenate([raw.stats for raw in raws]),
+                out=features[:, num_types:])
+
+        return [FeatureTree(features[offsets[i]:offsets[i + 1]], raw.left, raw.right)
+                for i, raw in enumerate(raws)]
 
     def plan_to_feature_tree(self, plan):
-        children = plan["Plans"] if "Plans" in plan else []
-
-        if len(children) == 1:
-            return self.plan_to_feature_tree(children[0])
-
-        if is_join(plan):
-            assert len(children) == 2
-            my_vec = self.__featurize_join(plan)
-            left = self.plan_to_feature_tree(children[0])
-            right = self.plan_to_feature_tree(children[1])
-            return (my_vec, left, right)
-
-        if is_scan(plan):
-            assert not children
-            return self.__featurize_scan(plan)
-
-        raise TreeBuilderError("Node wasn't transparent, a join, or a scan: " + str(plan))
+        return self.raw_to_feature_tree(_extract_plan_tree(plan, None))
 
 def norm(x, lo, hi):
     return (np.log(x + 1) - lo) / (hi - lo)
 
+def range_drift(lo, hi, new_lo, new_hi):
+    """
+    How far [new_lo, new_hi] extends outside of [lo, hi], as a fraction
+    of the width of [lo, hi].
+    """
+    outside = max(lo - new_lo, new_hi - hi, 0)
+    if outside == 0:
+        return 0.0
+    if hi <= lo:
+        return np.inf
+    return outside / (hi - lo)
+
 def get_buffer_count_for_leaf(leaf, buffers):
     total = 0
     if "Relation Name" in leaf:
@@ -90,14 +153,35 @@ class StatExtractor:
         self.__mins = mins
         self.__maxs = maxs
 
+    def ranges(self):
+        return {f: (lo, hi) for f, lo, hi
+                in zip(self.__fields, self.__mins, self.__maxs)}
+
+    def num_fields(self):
+        return len(self.__fields)
+
     def __call__(self, inp):
-        res = []
-        for f, lo, hi in zip(self.__fields, self.__mins, self.__maxs):
-            if f not in inp:
-                res.append(0)
-            else:
-                res.append(norm(inp[f], lo, hi))
-        return res
+        stats = np.array([[inp.get(f, np.nan) for f in RAW_STAT_FIELDS]],
+                         dtype=np.float64)
+        return list(self.transform_columns(stats)[0])
+
+    def transform_columns(self, stats, out=None):
+        """
+        Normalize a (nodes x len(RAW_STAT_FIELDS)) matrix of raw node
+        statistics, with NaN where a node does not have a statistic.
+        Returns a (nodes x fields) matrix, with 0 for missing values,
+        written to `out` if given.
+        """
+        cols = stats[:, [RAW_STAT_FIELDS.index(f) for f in self.__fields]]
+        lo = np.array(self.__mins, dtype=np.float64)
+        hi = np.array(self.__maxs, dtype=np.float64)
+
+        res = norm(cols, lo, hi)
+        res[np.isnan(cols)] = 0
+        if out is None:
+            return res
+        out[...] = res
+        return out
 
 def get_plan_stats(data):
     costs = []
@@ -175,38 +259,193 @@ def get_featurized_trees(data):
             
     return trees
 
-def _attach_buf_data(tree):
-    if "Buffers" not in tree:
-        return
-
-    buffers = tree["Buffers"]
-
-    def recurse(n):
-        if "Plans" in n:
-            for child in n["Plans"]:
-                recurse(child)
-            return
-        
-        # it is a leaf
-        n["Buffers"] = get_buffer_count_for_leaf(n, buffers)
-
-    recurse(tree["Plan"])
+# Statistics recorded for each plan node, in the column order of
+# RawPlan.stats.
+RAW_STAT_FIELDS = ["Buffers", "Total Cost", "Plan Rows"]
+
+# Bump when the output of extract_plan changes, so that cached RawPlans
+# are re-extracted.
+RAW_PLAN_VERSION = 1
+
+# A plan reduced to what featurization needs, independent of any fitted
+# normalization, so it can be computed once per plan and cached:
+#  - node_types: for each join/scan node (in preorder), its index in ALL_TYPES
+#  - stats: (nodes x RAW_STAT_FIELDS) raw statistics, NaN where missing
+#  - left, right: child positions, as in FeatureTree
+#  - stat_ranges: (RAW_STAT_FIELDS x 2) min and max of log(x + 1) of each
+#    statistic over *all* nodes of the plan (NaN if no node has it)
+#  - relations: the relation names appearing in the plan
+#  - bitmap_index_names: index names of bitmap index scans without a
+#    relation name, which are resolved against the known relations
+RawPlan = namedtuple("RawPlan", ["node_types", "stats", "left", "right",
+                                 "stat_ranges", "relations",
+                                 "bitmap_index_names"])
+
+def _node_stats(node, buffers):
+    if buffers is not None and "Plans" not in node:
+        # it is a leaf, use its share of the plan's buffer state
+        buf = get_buffer_count_for_leaf(node, buffers)
+    else:
+        buf = node.get("Buffers", np.nan)
+    return (buf, node["Total Cost"], node["Plan Rows"])
+
+def _extract_plan_tree(root, buffers):
+    node_types = []
+    stats = []
+    left = []
+    right = []
+    all_stats = []
+    relations = set()
+    bitmap_index_names = []
+
+    def visit(node):
+        node_stats = _node_stats(node, buffers)
+        all_stats.append(node_stats)
+        if "Relation Name" in node:
+            relations.add(node["Relation Name"])
+        return node_stats
+
+    # each entry is a node and the child list (left or right) and
+    # position of its parent that should point to it.
+    stack = [(root, None, None)]
+    while stack:
+        node, parent_list, parent_pos = stack.pop()
+        node_stats = visit(node)
+
+        # skip over transparent (single-child) operators
+        children = node["Plans"] if "Plans" in node else []
+        while len(children) == 1:
+            node = children[0]
+            node_stats = visit(node)
+            children = node["Plans"] if "Plans" in node else []
+
+        my_pos = len(node_types)
+        if parent_list is not None:
+            parent_list[parent_pos] = my_pos + 1
+
+        if is_join(node):
+            assert len(children) == 2
+            stack.append((children[1], right, my_pos))
+            stack.append((children[0], left, my_pos))
+        elif is_scan(node):
+            assert not children
+            if "Relation Name" not in node:
+                if node["Node Type"] != "Bitmap Index Scan":
+                    raise TreeBuilderError("Cannot extract relation type from node")
+                if "Index Name" not in node:
+                    print(node)
+                    raise TreeBuilderError("Bitmap operator did not have an index name or a relation name")
+                bitmap_index_names.append(node["Index Name"])
+        else:
+            raise TreeBuilderError("Node wasn't transparent, a join, or a scan: "
+                                   + str(node))
+
+        node_types.append(ALL_TYPES.index(node["Node Type"]))
+        stats.append(node_stats)
+        left.append(0)
+        right.append(0)
+
+    with np.errstate(invalid="ignore"):
+        log_stats = np.log(np.array(all_stats, dtype=np.float64) + 1)
+    stat_ranges = np.full((len(RAW_STAT_FIELDS), 2), np.nan)
+    for i in range(len(RAW_STAT_FIELDS)):
+        col = log_stats[:, i]
+        col = col[~np.isnan(col)]
+        if len(col) != 0:
+            stat_ranges[i] = (np.min(col), np.max(col))
+
+    return RawPlan(np.array(node_types, dtype=np.int32),
+                   np.array(stats, dtype=np.float64),
+                   np.array(left, dtype=np.int32),
+                   np.array(right, dtype=np.int32),
+                   stat_ranges,
+                   tuple(sorted(relations)),
+                   tuple(bitmap_index_names))
+
+def extract_plan(plan):
+    """
+    Reduce a plan (as sent by the Bao extension, optionally with the
+    buffer state under "Buffers") to a RawPlan.
+    """
+    return _extract_plan_tree(plan["Plan"], plan.get("Buffers", None))
+
+def extract_plans(trees):
+    """ Extract each plan that is not already a RawPlan. """
+    return [x if isinstance(x, RawPlan) else extract_plan(x) for x in trees]
+
+def get_raw_plan_stats(raws):
+    ranges = np.stack([x.stat_ranges for x in raws])
+    mins = []
+    maxs = []
+    for i in range(len(RAW_STAT_FIELDS)):
+        present = ~np.isnan(ranges[:, i, 0])
+        if not present.any():
+            mins.append(None)
+            maxs.append(None)
+            continue
+        mins.append(np.min(ranges[present, i, 0]))
+        maxs.append(np.max(ranges[present, i, 1]))
+
+    bufs_min, costs_min, rows_min = mins
+    bufs_max, costs_max, rows_max = maxs
+
+    if bufs_min is not None:
+        return StatExtractor(
+            ["Buffers", "Total Cost", "Plan Rows"],
+            [bufs_min, costs_min, rows_min],
+            [bufs_max, costs_max, rows_max]
+        )
+    else:
+        return StatExtractor(
+            ["Total Cost", "Plan Rows"],
+            [costs_min, rows_min],
+            [costs_max, rows_max]
+        )
 
 class TreeFeaturizer:
     def __init__(self):
         self.__tree_builder = None
 
     def fit(self, trees):
-        for t in trees:
-            _attach_buf_data(t)
-        all_rels = get_all_relations(trees)
-        stats_extractor = get_plan_stats(trees)
+        raws = extract_plans(trees)
+        all_rels = set()
+        for raw in raws:
+            all_rels.update(raw.relations)
+        stats_extractor = get_raw_plan_stats(raws)
         self.__tree_builder = TreeBuilder(stats_extractor, all_rels)
+        for raw in raws:
+            self.__tree_builder.resolve_index_names(raw.bitmap_index_names)
 
     def transform(self, trees):
-        for t in trees:
-            _attach_buf_data(t)
-        return [self.__tree_builder.plan_to_feature_tree(x["Plan"]) for x in trees]
+        return self.__tree_builder.raws_to_feature_trees(extract_plans(trees))
+
+    def range_drift(self, trees):
+        """
+        How far the statistics of `trees` fall outside of the ranges this
+        featurizer was fit on (see `range_drift`), taking the largest over
+        all statistics. Infinite if `trees` have a different set of
+        statistics (e.g., buffer information appeared or disappeared).
+        """
+        old = self.__tree_builder.stats_extractor().ranges()
+        new = get_raw_plan_stats(extract_plans(trees)).ranges()
+        if old.keys() != new.keys():
+            return np.inf
+
+        return max(range_drift(lo, hi, *new[f]) for f, (lo, hi) in old.items())
+
+    def with_relations_of(self, trees):
+        """
+        Returns a copy of this featurizer, with the same fitted statistics
+        ranges, that also knows about the relations appearing in `trees`.
+        """
+        all_rels = self.__tree_builder.relations()
+        for raw in extract_plans(trees):
+            all_rels.update(raw.relations)
+
+        featurizer = TreeFeaturizer()
+        featurizer.__tree_builder = TreeBuilder(
+            self.__tree_builder.stats_extractor(), all_rels)
+        return featurizer
 
     def num_operators(self):
         return len(ALL_TYPES)
@@ -0,0 +1,121 @@
+import threading
+import time
+from concurrent.futures import Future
+
+class InferenceBatcher:
+    """
+    Coalesces the plans of concurrent prediction requests that arrive
+    within a small time window into a single model forward pass, and
+    scatters the predictions back to each caller.
+    """
+    def __init__(self, window_ms, max_plans=256):
+        self.__window = window_ms / 1000.0
+        self.__max_plans = max_plans
+        self.__pending = []
+        self.__pending_plans = 0
+        self.__deadline = None
+        self.__cond = threading.Condition()
+
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="bao-batcher",
+                                         daemon=True)
+        self.__thread.start()
+
+    def predict(self, model, plans, return_embedding=False):
+        """
+        Predict `plans` with `model`, blocking until the batch containing
+        them has been evaluated. Returns the same array `model.predict`
+        would have returned for `plans` alone (and, if requested, the
+        embedding rows of `plans`).
+        """
+        future = Future()
+        with self.__cond:
+            if not self.__pending:
+                # the first request opens the window
+                self.__deadline = time.monotonic() + self.__window
+            self.__pending.append((model, plans, return_embedding, future))
+            self.__pending_plans += len(plans)
+            self.__cond.notify()
+        return future.result()
+
+    def __next_batch(self):
+        with self.__cond:
+            while not self.__pending:
+                self.__cond.wait()
+
+            # wait for the window to close (or for the batch to fill up).
+            while self.__pending_plans < self.__max_plans:
+                remaining = self.__deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__cond.wait(remaining)
+
+            # take requests up to max_plans plans (but at least one). The
+            # rest stay queued for the next batch, and since their window
+            # has already closed, it follows right away.
+            num_plans = 0
+            num_requests = 0
+            for _model, plans, _return_embedding, _future in self.__pending:
+                if num_requests and num_plans + len(plans) > self.__max_plans:
+                    break
+                num_plans += len(plans)
+                num_requests += 1
+
+            batch = self.__pending[:num_requests]
+            self.__pending = self.__pending[num_requests:]
+            self.__pending_plans -= num_plans
+            return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+
+            # a model swap can land in the middle of a window, so only
+            # requests against the same model share a forward pass.
+            by_model = {}
+            for request in batch:
+                by_model.setdefault(id(request[0]), []).append(request)
+
+            for requests in by_model.values():
+                self.__predict_batch(requests)
+
+    def __predict_one(self, request):
+        model, plans, return_embedding, future = request
+        try:
+            if return_embedding:
+                future.set_result(model.predict(plans, return_embedding=True))
+            else:
+                future.set_result(model.predict(plans))
+        except Exception as e:
+            future.set_exception(e)
+
+    def __predict_batch(self, requests):
+        model = requests[0][0]
+        all_plans = []
+        for _model, plans, _return_embedding, _future in requests:
+            all_plans.extend(plans)
+        want_embedding = any(x[2] for x in requests)
+
+        try:
+            if want_embedding:
+                res, embedding = model.predict(all_plans, return_embedding=True)
+            else:
+                res = model.predict(all_plans)
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0][3].set_exception(e)
+                return
+            # one bad plan must not fail the other requests of the
+            # batch, so find out which requests fail on their own.
+            for request in requests:
+                self.__predict_one(request)
+            return
+
+        offset = 0
+        for _model, plans, return_embedding, future in requests:
+            end = offset + len(plans)
+            if return_embedding:
+                future.set_result((res[offset:end], embedding[offset:end]))
+            else:
+                future.set_result(res[offset:end])
+            offset = end
@@ -1,8 +1,12 @@
 import socketserver
+import asyncio
+import functools
 import json
+import signal
 import struct
 import sys
 import time
+import traceback
 import os
 import storage
 import model
@@ -10,23 +14,52 @@ import train
 import baoctl
 import math
 import reg_blocker
+from inference_batcher import InferenceBatcher
+from plan_cache import PlanCache
+from embedding_store import EmbeddingStore
+from reward_writer import RewardWriter
 from constants import (PG_OPTIMIZER_INDEX, DEFAULT_MODEL_PATH,
                        OLD_MODEL_PATH, TMP_MODEL_PATH)
 import argparse
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-SERVER_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-TEMP_EMBEDDING_FILE = os.path.join(SERVER_SCRIPT_DIR, "bao_last_embedding.tmp.json")
-TEMP_FILE_LOCK = threading.Lock()
+# upper bound on a single protocol line; a query message carries one
+# plan per line, so this only needs to fit the largest single plan.
+MAX_LINE_BYTES = 64 * 1024 * 1024
 
-def add_buffer_info_to_plans(buffer_info, plans):
-    for p in plans:
-        p["Buffers"] = buffer_info
-    return plans
+# number of recorded plans to run through a freshly loaded model before
+# it starts serving queries.
+WARMUP_PLANS = 16
+
+def with_buffer_info(buffer_info, plans):
+    # shallow copies, so the parsed messages (and anything sharing them)
+    # are never modified.
+    return [dict(p, Buffers=buffer_info) for p in plans]
 
 class BaoModel:
-    def __init__(self, log_performance=False, log_file_path="performance_log.txt"):
+    def __init__(self, log_performance=False, log_file_path="performance_log.txt",
+                 batch_window_ms=0, batch_max_plans=256, plan_cache_size=0,
+                 capture_embeddings=False, embedding_buffer_size=256,
+                 reward_flush_interval_ms=100, reward_batch_size=256,
+                 reward_queue_size=8192, freeze_inference=False):
         self.__current_model = None
+        self.__freeze_inference = freeze_inference
+        self.capture_embeddings = capture_embeddings
+        self.embeddings = EmbeddingStore(embedding_buffer_size)
+        self.rewards = RewardWriter(reward_flush_interval_ms, reward_batch_size,
+                                    reward_queue_size)
+        self.__batcher = None
+        if batch_window_ms > 0:
+            self.__batcher = InferenceBatcher(batch_window_ms, batch_max_plans)
+        self.__plan_cache = None
+        if plan_cache_size > 0:
+            self.__plan_cache = PlanCache(plan_cache_size)
+        # loads run one at a time off the serving threads; readers grab
+        # a reference to the current model once per request instead.
+        self.__loader = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix="bao-loader")
+        self.__log_lock = threading.Lock()
         self.log_performance = log_performance
         
         # We can still keep the analysis directory for a simple performance log,
@@ -41,21 +74,64 @@ class BaoModel:
     def log_performance_to_file(self, predicted_latency, inference_time):
         """Logs performance metrics to a file."""
         if self.log_performance:
-            with open(self.log_file_path, "a") as log_file:
+            with self.__log_lock, open(self.log_file_path, "a") as log_file:
                 log_file.write(f"Timestamp: {time.time()}, BestPredictedLatency: {predicted_latency}, InferenceTime: {inference_time}\n")
 
-    def select_plan(self, messages):
+    def __predict(self, current_model, plans, return_embedding=False):
+        if self.__batcher is not None:
+            return self.__batcher.predict(current_model, plans,
+                                          return_embedding=return_embedding)
+        if return_embedding:
+            return current_model.predict(plans, return_embedding=True)
+        return current_model.predict(plans)
+
+    def cache_stats(self):
+        if self.__plan_cache is None:
+            return {"enabled": False}
+        return dict(self.__plan_cache.stats(), enabled=True)
+
+    def select_plan(self, messages, return_embedding=False):
+        """
+        Returns the index of the arm with the best predicted latency. If
+        `return_embedding` is set, returns a tuple of the index and the
+        model's embedding of each arm (None if no model is loaded).
+        """
         start = time.time()
         *arms, buffers = messages
+        cache = self.__plan_cache
+        if cache is not None:
+            # read the generation before the model, see PlanCache.generation
+            generation = cache.generation
+        current_model = self.__current_model
 
         # if we don't have a model, default to the PG optimizer
-        if self.__current_model is None:
+        if current_model is None:
             print("No model loaded, defaulting to PG optimizer.")
+            if return_embedding:
+                return PG_OPTIMIZER_INDEX, None
             return PG_OPTIMIZER_INDEX
 
+        if cache is not None:
+            cache_key = PlanCache.key(arms, buffers)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                idx, best_latency, pg_latency, embedding = cached
+                inference_time = time.time() - start
+                if self.log_performance:
+                    self.log_performance_to_file(best_latency, inference_time)
+                print(f"Selected cached index {idx} after {round(inference_time * 1000)}ms. "
+                      f"Predicted reward / PG: {best_latency} / {pg_latency}", flush=True)
+                if return_embedding:
+                    return idx, embedding
+                return idx
+
         # if we do have a model, make predictions for each plan.
-        arms = add_buffer_info_to_plans(buffers, arms)
-        res = self.__current_model.predict(arms)
+        arms = with_buffer_info(buffers, arms)
+        embedding = None
+        if return_embedding:
+            res, embedding = self.__predict(current_model, arms, return_embedding=True)
+        else:
+            res = self.__predict(current_model, arms)
         idx = res.argmin()
 
         # Force index 3 which is the hash join plan
@@ -72,63 +148,172 @@ class BaoModel:
         if self.log_performance:
             self.log_performance_to_file(best_latency, inference_time)
 
+        if cache is not None:
+            cache.put(cache_key, (idx, best_latency, res[0][0], embedding), generation)
+
         print(f"Selected index {idx} after {round(inference_time * 1000)}ms. "
               f"Predicted reward / PG: {res[idx][0]} / {res[0][0]}", flush=True)
+        if return_embedding:
+            return idx, embedding
         return idx
 
     def predict(self, messages):
         # the last message is the buffer state
         plan, buffers = messages
+        current_model = self.__current_model
 
         # if we don't have a model, make a prediction of NaN
-        if self.__current_model is None:
+        if current_model is None:
             return math.nan
 
         # if we do have a model, make predictions for each plan.
-        plans = add_buffer_info_to_plans(buffers, [plan])
-        res = self.__current_model.predict(plans)
+        plans = with_buffer_info(buffers, [plan])
+        res = self.__predict(current_model, plans)
         return res[0][0]
     
     def load_model(self, fp):
-        # import model_lightning as model
-        import model
+        """
+        Load, check and warm up the model at `fp` in the background, and
+        swap it in once it is ready. Returns a future that resolves to
+        whether the new model was accepted. If loading fails, the current
+        model stays in place.
+        """
+        future = self.__loader.submit(self.__load_model, fp)
+        # most callers never look at the future, so report failures here
+        future.add_done_callback(functools.partial(self.__report_load, fp))
+        return future
+
+    def __report_load(self, fp, future):
+        e = future.exception()
+        if e is not None:
+            print(f"Failed to load Bao model from {fp}, keeping the current model. "
+                  + f"Exception: {e!r}")
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    def __warm_up(self, new_model):
+        # warming up is only an optimization: stored plans the new model
+        # cannot featurize are skipped, and never keep it from loading.
+        try:
+            warmup_plans = storage.sample_experience(WARMUP_PLANS)
+        except Exception as e:
+            print("Could not read plans to warm up the new model:", repr(e))
+            return
+        if not warmup_plans:
+            return
+
         try:
-            new_model = model.BaoRegression(have_cache_data=True)
-            new_model.load(fp)
-
-            if reg_blocker.should_replace_model(
-                    self.__current_model,
-                    new_model):
-                self.__current_model = new_model
-                print("Accepted new model.")
-            else:
-                print("Rejecting load of new model due to regression profile.")
-                
+            new_model.predict(warmup_plans)
+            return
         except Exception as e:
-            print("Failed to load Bao model from", fp,
-                  "Exception:", sys.exc_info()[0])
-            raise e
-            
+            print("Could not warm up the new model on", len(warmup_plans),
+                  "stored plan(s), trying one at a time. Exception:", repr(e))
+
+        for plan in warmup_plans:
+            try:
+                new_model.predict([plan])
+            except Exception:
+                continue
+
+    def __load_model(self, fp):
+        # import model_lightning as model
+        import model
+        new_model = model.BaoRegression(have_cache_data=True)
+        new_model.load(fp, freeze=self.__freeze_inference)
+
+        # the first forward pass pays for lazy initialization, so
+        # make sure it doesn't happen on a planning request.
+        self.__warm_up(new_model)
+
+        if not reg_blocker.should_replace_model(
+                self.__current_model,
+                new_model):
+            print("Rejecting load of new model due to regression profile.")
+            return False
+
+        # a single reference assignment, so concurrent
+        # requests see either the old or the new model.
+        self.__current_model = new_model
+        if self.__plan_cache is not None:
+            self.__plan_cache.invalidate()
+        print("Accepted new model.")
+        return True
+
+
+def handle_messages(bao_model, messages, reply):
+    """
+    Handle one complete exchange of the newline-delimited Bao protocol.
+    `messages` holds the parsed lines starting with the {"type": ...}
+    header, up to (but excluding) the {"final": true} terminator.
+    `reply` is called with the bytes to send back to the client, for the
+    message types that have a response.
+    """
+    header = messages[0]
+    message_type = header["type"]
+    messages = messages[1:]
+
+    if message_type == "query":
+        if bao_model.capture_embeddings:
+            result, embedding = bao_model.select_plan(messages, return_embedding=True)
+            # store the embedding before replying, so it is available as
+            # soon as the backend has its plan.
+            if embedding is not None:
+                bao_model.embeddings.add(header.get("pid"), embedding)
+        else:
+            result = bao_model.select_plan(messages)
+        reply(struct.pack("I", result))
+    elif message_type == "predict":
+        result = bao_model.predict(messages)
+        reply(struct.pack("d", result))
+    elif message_type == "reward":
+        plan, buffers, obs_reward = messages
+        plan = with_buffer_info(buffers, [plan])[0]
+        bao_model.rewards.record(plan, obs_reward["reward"], obs_reward["pid"])
+    elif message_type == "flush rewards":
+        # replies once every reward received so far is in the database.
+        bao_model.rewards.flush()
+        reply((json.dumps({"flushed": True}) + "\n").encode("UTF-8"))
+    elif message_type == "load model":
+        path = messages[0]["path"]
+        print("Loading model from", path)
+        # the model is swapped in once it is ready; only if the client
+        # asked to wait, reply then with whether it was accepted.
+        future = bao_model.load_model(path)
+        if header.get("wait"):
+            try:
+                accepted = future.result()
+            except Exception:
+                accepted = False
+            reply((json.dumps({"accepted": accepted}) + "\n").encode("UTF-8"))
+    elif message_type == "get embedding":
+        embedding_data = bao_model.embeddings.take(header.get("pid"))
+        reply((json.dumps(embedding_data) + "\n").encode("UTF-8"))
+    elif message_type == "cache stats":
+        reply((json.dumps(bao_model.cache_stats()) + "\n").encode("UTF-8"))
+    else:
+        print("Unknown message type:", message_type)
+
 
 class JSONTCPHandler(socketserver.BaseRequestHandler):
     def handle(self):
-        str_buf = ""
-        while True:
-            str_buf += self.request.recv(1024).decode("UTF-8")
-            if not str_buf:
-                # no more data, connection is finished.
-                return
-            
-            if (null_loc := str_buf.find("\n")) != -1:
-                json_msg = str_buf[:null_loc].strip()
-                str_buf = str_buf[null_loc + 1:]
-                if json_msg:
-                    try:
-                        if self.handle_json(json.loads(json_msg)):
-                            break
-                    except json.decoder.JSONDecodeError:
-                        print("Error decoding JSON:", json_msg)
+        # read whole lines from a buffered binary reader so that large
+        # messages are not re-copied per chunk, and multibyte UTF-8
+        # sequences are never split before decoding.
+        with self.request.makefile("rb") as rfile:
+            for line in rfile:
+                if not line.endswith(b"\n"):
+                    # connection closed in the middle of a message.
+                    return
+
+                json_msg = line.strip()
+                if not json_msg:
+                    continue
+
+                try:
+                    if self.handle_json(json.loads(json_msg)):
                         break
+                except json.decoder.JSONDecodeError:
+                    print("Error decoding JSON:", json_msg)
+                    break
 
 
 class BaoJSONHandler(JSONTCPHandler):
@@ -137,74 +322,152 @@ class BaoJSONHandler(JSONTCPHandler):
         self.__messages = []
 
     def handle_json(self, data):
-        activation = {}
-
-        def getActivation(name):
-            def hook(model, input, output):
-                activation[name] = output[0].detach().cpu().numpy()  # Convert to numpy
-            return hook
-
-        if (self.server.bao_model._BaoModel__current_model is not None and
-            hasattr(self.server.bao_model._BaoModel__current_model, '_BaoRegression__net')):
-            h = self.server.bao_model._BaoModel__current_model._BaoRegression__net.tree_conv[8].register_forward_hook(
-                getActivation('TreeLayerNorm'))
-        else:
-            h = None
-
         if "final" in data:
-            message_type = self.__messages[0]["type"]
-            self.__messages = self.__messages[1:]
-
-            if message_type == "query":
-                result = self.server.bao_model.select_plan(self.__messages)
-                self.request.sendall(struct.pack("I", result))
-                if 'TreeLayerNorm' in activation:
-                    embedding = activation['TreeLayerNorm']
-                    embedding_data = {
-                        "embedding": embedding.tolist(),  # Convert to list for JSON
-                        "timestamp": time.time()
-                    }
-                    # Use the lock to safely write to the file.
-                    with TEMP_FILE_LOCK:
-                        try:
-                            with open(TEMP_EMBEDDING_FILE, 'w') as f:
-                                json.dump(embedding_data, f)
-                            # print(f"Successfully wrote embedding to {TEMP_EMBEDDING_FILE}")
-                        except Exception as e:
-                            print(f"ERROR: Failed to write to temp embedding file: {e}")
-                self.request.close()
-            elif message_type == "predict":
-                result = self.server.bao_model.predict(self.__messages)
-                self.request.sendall(struct.pack("d", result))
-                self.request.close()
-            elif message_type == "reward":
-                plan, buffers, obs_reward = self.__messages
-                plan = add_buffer_info_to_plans(buffers, [plan])[0]
-                storage.record_reward(plan, obs_reward["reward"], obs_reward["pid"])
-            elif message_type == "load model":
-                path = self.__messages[0]["path"]
-                print("Loading model from", path)
-                self.server.bao_model.load_model(path)
-            else:
-                print("Unknown message type:", message_type)
-            
+            handle_messages(self.server.bao_model, self.__messages,
+                            self.request.sendall)
+            self.request.close()
             return True
 
         self.__messages.append(data)
         return False
-                
 
-def start_server(listen_on, port, log_performance=False, log_file_path="performance_log.txt"):
-    model = BaoModel(log_performance=log_performance, log_file_path=log_file_path)
 
-    if os.path.exists(DEFAULT_MODEL_PATH):
-        print("Loading existing model")
-        model.load_model(DEFAULT_MODEL_PATH)
-    
-    socketserver.TCPServer.allow_reuse_address = True
-    with socketserver.TCPServer((listen_on, port), BaoJSONHandler) as server:
-        server.bao_model = model
-        server.serve_forever()
+async def handle_connection(bao_model, executor, reader, writer):
+    """
+    Serve one connection of the Bao protocol on the event loop. Lines are
+    split out of the stream's byte buffer by the StreamReader, and the
+    (blocking) model and storage work is run on `executor`.
+    """
+    loop = asyncio.get_running_loop()
+
+    def reply(data):
+        loop.call_soon_threadsafe(writer.write, data)
+
+    messages = []
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                print("Bao message exceeded", MAX_LINE_BYTES, "bytes, closing connection.")
+                return
+
+            if not line.endswith(b"\n"):
+                # no more data, connection is finished.
+                return
+
+            json_msg = line.strip()
+            if not json_msg:
+                continue
+
+            try:
+                data = json.loads(json_msg)
+            except json.decoder.JSONDecodeError:
+                print("Error decoding JSON:", json_msg)
+                return
+
+            if "final" in data:
+                await loop.run_in_executor(executor, handle_messages,
+                                           bao_model, messages, reply)
+                await writer.drain()
+                return
+
+            messages.append(data)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class BaoTCPServer(socketserver.TCPServer):
+    """
+    A TCP server that hands each connection to a bounded pool of worker
+    threads, so a slow request (e.g., a reward insert or a model load)
+    does not block query planning on other connections.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler, max_workers):
+        super().__init__(server_address, handler)
+        self.__workers = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="bao-worker")
+
+    def process_request(self, request, client_address):
+        self.__workers.submit(self.__process_request_thread,
+                              request, client_address)
+
+    def __process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.__workers.shutdown(wait=True)
+
+
+async def serve_asyncio(listen_on, port, bao_model, max_workers):
+    executor = ThreadPoolExecutor(max_workers=max_workers,
+                                  thread_name_prefix="bao-worker")
+    server = await asyncio.start_server(
+        functools.partial(handle_connection, bao_model, executor),
+        listen_on, port, limit=MAX_LINE_BYTES, reuse_address=True)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=True)
+
+
+def _exit_on_sigterm(signum, frame):
+    sys.exit(0)
+
+def start_server(listen_on, port, log_performance=False, log_file_path="performance_log.txt",
+                 max_workers=1, server_mode="threaded", batch_window_ms=0,
+                 batch_max_plans=256, plan_cache_size=0, capture_embeddings=False,
+                 embedding_buffer_size=256, reward_flush_interval_ms=100,
+                 reward_batch_size=256, reward_queue_size=8192, plan_encoding="json",
+                 experience_window=0, experience_per_template=0, experience_max_rows=0,
+                 freeze_inference=False):
+    storage.set_plan_encoding(plan_encoding)
+    storage.set_retention_policy(experience_window, experience_per_template,
+                                 experience_max_rows)
+    storage.enforce_retention()
+    model = BaoModel(log_performance=log_performance, log_file_path=log_file_path,
+                     batch_window_ms=batch_window_ms, batch_max_plans=batch_max_plans,
+                     plan_cache_size=plan_cache_size,
+                     capture_embeddings=capture_embeddings,
+                     embedding_buffer_size=embedding_buffer_size,
+                     reward_flush_interval_ms=reward_flush_interval_ms,
+                     reward_batch_size=reward_batch_size,
+                     reward_queue_size=reward_queue_size,
+                     freeze_inference=freeze_inference)
+
+    # the reward writer is a daemon thread, so write out the rewards it
+    # still holds before exiting, including when terminated.
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        if os.path.exists(DEFAULT_MODEL_PATH):
+            print("Loading existing model")
+            model.load_model(DEFAULT_MODEL_PATH).result()
+
+        if server_mode == "asyncio":
+            asyncio.run(serve_asyncio(listen_on, port, model, max_workers))
+            return
+
+        if server_mode != "threaded":
+            print("Unknown ServerMode", server_mode, "- using threaded")
+
+        with BaoTCPServer((listen_on, port), BaoJSONHandler, max_workers) as server:
+            server.bao_model = model
+            server.serve_forever()
+    finally:
+        print("Writing pending rewards before exiting")
+        model.rewards.flush()
 
 
 if __name__ == "__main__":
@@ -223,10 +486,36 @@ if __name__ == "__main__":
     config = read_config()
     port = int(config["Port"])
     listen_on = config["ListenOn"]
+    max_workers = int(config.get("MaxWorkers", 1))
+    server_mode = config.get("ServerMode", "threaded")
+    batch_window_ms = float(config.get("InferenceBatchWindowMs", 0))
+    batch_max_plans = int(config.get("InferenceBatchMaxPlans", 256))
+    plan_cache_size = int(config.get("PlanCacheSize", 0))
+    capture_embeddings = config.getboolean("CaptureEmbeddings", False)
+    embedding_buffer_size = int(config.get("EmbeddingBufferSize", 256))
+    freeze_inference = config.getboolean("FreezeInference", False)
+    reward_flush_interval_ms = float(config.get("RewardFlushIntervalMs", 100))
+    reward_batch_size = int(config.get("RewardBatchSize", 256))
+    reward_queue_size = int(config.get("RewardQueueSize", 8192))
+    plan_encoding = config.get("PlanEncoding", "json")
+    experience_window = int(config.get("ExperienceWindow", 0))
+    experience_per_template = int(config.get("ExperiencePerTemplate", 0))
+    experience_max_rows = int(config.get("ExperienceMaxRows", 0))
 
-    print(f"Listening on {listen_on} port {port}")
+    print(f"Listening on {listen_on} port {port} with {max_workers} worker(s) ({server_mode})")
     
-    server = Process(target=start_server, args=[listen_on, port, args.log_performance, args.log_file_path])
+    server = Process(target=start_server, args=[listen_on, port, args.log_performance, args.log_file_path,
+                                                max_workers, server_mode, batch_window_ms,
+                                                batch_max_plans, plan_cache_size,
+                                                capture_embeddings, embedding_buffer_size,
+                                                reward_flush_interval_ms, reward_batch_size,
+                                                reward_queue_size, plan_encoding,
+                                                experience_window, experience_per_template,
+                                                experience_max_rows, freeze_inference])
     
     print("Spawning server process...")
-    server.start()
\ No newline at end of file
+    server.start()
+
+    # pass termination on to the server process, so that it exits cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.terminate())
+    server.join()
\ No newline at end of file
@@ -4,18 +4,27 @@ import torch
 import torch.optim
 import joblib
 import os
+import time
 from sklearn import preprocessing
 from sklearn.pipeline import Pipeline
 
-from torch.utils.data import DataLoader
+from torch.utils.data import Sampler
 import net
-from featurize import TreeFeaturizer
+from TreeConvolution.util import PackedTrees
+from featurize import TreeFeaturizer, extract_plans, range_drift
 
 SERVER_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 LOSS_FILE_PATH = os.path.join(SERVER_SCRIPT_DIR, "last_training_loss.txt")
 
 CUDA = torch.cuda.is_available()
 
+BATCH_SIZE = 16
+# plans predicted in one forward pass when predicting many at once
+PREDICT_BATCH_SIZE = 256
+# batches whose trees are drawn from the same pool, and so sorted by size
+# together, in each epoch
+BUCKET_POOL_BATCHES = 50
+
 def _nn_path(base):
     return os.path.join(base, "nn_weights")
 
@@ -31,6 +40,12 @@ def _channels_path(base):
 def _n_path(base):
     return os.path.join(base, "n")
 
+def _last_experience_id_path(base):
+    return os.path.join(base, "last_experience_id")
+
+def _frozen_nn_path(base):
+    return os.path.join(base, "nn_frozen")
+
 
 def _inv_log1p(x):
     return np.exp(x) - 1
@@ -47,22 +62,52 @@ class BaoData:
         return (self.__data[idx]["tree"],
                 self.__data[idx]["target"])
 
-def collate(x):
-    trees = []
-    targets = []
+class BucketBatchSampler(Sampler):
+    """
+    Batches of indexes of trees of similar size (`sizes` are node counts),
+    so that little of each batch is padding. Each epoch, the trees are
+    shuffled into pools of `pool_batches` batches, each pool is sorted by
+    size and cut into batches, and the batches of all pools are shuffled,
+    so batches still differ from epoch to epoch.
+    """
+    def __init__(self, sizes, batch_size, pool_batches=BUCKET_POOL_BATCHES):
+        self.__sizes = torch.as_tensor(sizes)
+        self.__batch_size = batch_size
+        self.__pool_size = batch_size * pool_batches
 
-    for tree, target in x:
-        trees.append(tree)
-        targets.append(target)
-
-    targets = torch.tensor(targets)
-    return trees, targets
+    def __len__(self):
+        return (len(self.__sizes) + self.__batch_size - 1) // self.__batch_size
+
+    def __iter__(self):
+        order = torch.randperm(len(self.__sizes))
+        batches = []
+        for pool in torch.split(order, self.__pool_size):
+            pool = pool[torch.argsort(self.__sizes[pool], stable=True)]
+            batches.extend(torch.split(pool, self.__batch_size))
+
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i].tolist()
+
+def padding_waste(sizes, batches):
+    """
+    The fraction of the tree positions in `batches` (lists of indexes into
+    node counts `sizes`) that are padding, as each tree is padded to the
+    largest in its batch.
+    """
+    nodes = 0
+    padded = 0
+    for batch in batches:
+        batch_sizes = [sizes[i] for i in batch]
+        nodes += sum(batch_sizes)
+        padded += len(batch_sizes) * max(batch_sizes)
+    return 1 - nodes / padded
 
 class BaoRegression:
     def __init__(self, verbose=False, have_cache_data=False):
         self.__net = None
         self.__verbose = verbose
         self.__fit_losses = []  # Track losses during training
+        self.__fit_stats = {}
 
         log_transformer = preprocessing.FunctionTransformer(
             np.log1p, _inv_log1p,
@@ -76,6 +121,7 @@ class BaoRegression:
         self.__have_cache_data = have_cache_data
         self.__in_channels = None
         self.__n = 0
+        self.__last_experience_id = None
         
     def __log(self, *args):
         if self.__verbose:
@@ -83,8 +129,34 @@ class BaoRegression:
 
     def num_items_trained_on(self):
         return self.__n
+
+    def last_experience_id(self):
+        """ The largest experience id this model was trained on, if known. """
+        return self.__last_experience_id
+
+    def set_last_experience_id(self, experience_id):
+        self.__last_experience_id = experience_id
+
+    def normalization_drift(self, X, y):
+        """
+        How far plans X and targets y fall outside of the normalization
+        ranges this model was fit on, as a fraction of the width of each
+        range (the largest over all plan statistics and the target).
+        """
+        X = [json.loads(x) if isinstance(x, str) else x for x in X]
+        drift = self.__tree_transform.range_drift(X)
+
+        y = np.log1p(np.asarray(y, dtype=np.float64))
+        scaler = self.__pipeline.named_steps["scale"]
+        return max(drift, range_drift(scaler.data_min_[0], scaler.data_max_[0],
+                                      np.min(y), np.max(y)))
             
-    def load(self, path):
+    def load(self, path, freeze=False):
+        """
+        Load the model saved at `path`. If `freeze` is set, also freeze the
+        network for inference (see `BaoNet.freeze`), reusing the frozen
+        network cached in `path` if it is up to date.
+        """
         with open(_n_path(path), "rb") as f:
             self.__n = joblib.load(f)
         with open(_channels_path(path), "rb") as f:
@@ -99,11 +171,26 @@ class BaoRegression:
         with open(_x_transform_path(path), "rb") as f:
             self.__tree_transform = joblib.load(f)
 
+        # models saved before warm starting existed do not have this
+        if os.path.exists(_last_experience_id_path(path)):
+            with open(_last_experience_id_path(path), "rb") as f:
+                self.__last_experience_id = joblib.load(f)
+
+        if freeze:
+            frozen = _frozen_nn_path(path)
+            if (os.path.exists(frozen)
+                    and os.path.getmtime(frozen) < os.path.getmtime(_nn_path(path))):
+                os.remove(frozen)
+            self.__net.freeze(frozen)
+
     def save(self, path):
         # try to create a directory here
         os.makedirs(path, exist_ok=True)
         
         torch.save(self.__net.state_dict(), _nn_path(path))
+        # a frozen network cached for older weights is stale
+        if os.path.exists(_frozen_nn_path(path)):
+            os.remove(_frozen_nn_path(path))
         with open(_y_transform_path(path), "wb") as f:
             joblib.dump(self.__pipeline, f)
         with open(_x_transform_path(path), "wb") as f:
@@ -112,32 +199,60 @@ class BaoRegression:
             joblib.dump(self.__in_channels, f)
         with open(_n_path(path), "wb") as f:
             joblib.dump(self.__n, f)
-
-    def fit(self, X, y):
+        with open(_last_experience_id_path(path), "wb") as f:
+            joblib.dump(self.__last_experience_id, f)
+
+    def fit(self, X, y, sample_weight=None, warm_start=None, max_epochs=100):
+        """
+        Train on plans X with latencies y, weighting the loss of each plan
+        by `sample_weight` (e.g., the number of times it was executed) if
+        given. If `warm_start` is another BaoRegression, start from its
+        network weights and keep its normalization of plans and latencies
+        (so that the weights stay meaningful) instead of training from
+        scratch.
+        """
         if isinstance(y, list):
             y = np.array(y)
+        if sample_weight is None:
+            sample_weight = np.ones(len(y))
 
         X = [json.loads(x) if isinstance(x, str) else x for x in X]
+        X = extract_plans(X)
         self.__n = len(X)
             
-        # transform the set of trees into feature vectors using a log
-        # (assuming the tail behavior exists, TODO investigate
-        #  the quantile transformer from scikit)
-        y = self.__pipeline.fit_transform(y.reshape(-1, 1)).astype(np.float32)
-        
-        self.__tree_transform.fit(X)
-        X = self.__tree_transform.transform(X)
+        if warm_start is None:
+            # transform the set of trees into feature vectors using a log
+            # (assuming the tail behavior exists, TODO investigate
+            #  the quantile transformer from scikit)
+            y = self.__pipeline.fit_transform(y.reshape(-1, 1)).astype(np.float32)
+            self.__tree_transform.fit(X)
+        else:
+            self.__pipeline = warm_start.__pipeline
+            y = self.__pipeline.transform(y.reshape(-1, 1)).astype(np.float32)
+            self.__tree_transform = warm_start.__tree_transform.with_relations_of(X)
+
+        # featurize and pack the training set once, so that each batch of
+        # each epoch is prepared by indexing into the packed tensors
+        packed = PackedTrees(self.__tree_transform.transform(X))
+        y = torch.from_numpy(y)
+        weights = torch.tensor(sample_weight, dtype=torch.float32).reshape(-1, 1)
+        if CUDA:
+            y = y.cuda()
+            weights = weights.cuda()
+        mean_weight = weights.mean()
 
-        pairs = list(zip(X, y))
-        dataset = DataLoader(pairs,
-                             batch_size=16,
-                             shuffle=True,
-                             collate_fn=collate)
+        sizes = packed.sizes.tolist()
+        sampler = BucketBatchSampler(sizes, BATCH_SIZE)
+
+        # compare against the batches the trees would get if unsorted
+        waste = padding_waste(sizes, list(sampler))
+        unsorted_waste = padding_waste(
+            sizes, torch.split(torch.randperm(len(sizes)), BATCH_SIZE))
+        self.__log(f"Padding: {waste:.1%} of tree positions "
+                   + f"({unsorted_waste:.1%} without bucketing)")
 
         # determine the initial number of channels
-        for inp, _tar in dataset:
-            in_channels = inp[0][0].shape[0]
-            break
+        in_channels = packed.features.shape[1]
 
         self.__log("Initial input channels:", in_channels)
 
@@ -148,27 +263,37 @@ class BaoRegression:
 
         self.__net = net.BaoNet(in_channels)
         self.__in_channels = in_channels
+        if warm_start is not None:
+            assert in_channels == warm_start.__in_channels
+            self.__net.load_state_dict(warm_start.__net.state_dict())
+            self.__log("Warm starting from a model trained on",
+                       warm_start.num_items_trained_on(), "items")
         if CUDA:
             self.__net = self.__net.cuda()
 
         optimizer = torch.optim.Adam(self.__net.parameters())
-        loss_fn = torch.nn.MSELoss()
         
         losses = []
-        for epoch in range(100):
+        start_time = time.time()
+        for epoch in range(max_epochs):
             loss_accum = 0
-            for x, y in dataset:
-                if CUDA:
-                    y = y.cuda()
-                y_pred = self.__net(x)
-                loss = loss_fn(y_pred, y)
+            for batch in sampler:
+                batch = torch.tensor(batch)
+                y_pred = self.__net(self.__net.prepare(packed, batch))
+                target = y[batch]
+                w = weights[batch]
+                # weighted MSE over a constant (not this batch's weight sum),
+                # so across an epoch a plan executed n times counts n times
+                # as much as a plan executed once.
+                loss = torch.sum(w * (y_pred - target) ** 2) \
+                    / (len(batch) * mean_weight)
                 loss_accum += loss.item()
         
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
 
-            loss_accum /= len(dataset)
+            loss_accum /= len(sampler)
             losses.append(loss_accum)
             if epoch % 15 == 0:
                 self.__log("Epoch", epoch, "training loss:", loss_accum)
@@ -185,6 +310,12 @@ class BaoRegression:
         else:
             self.__log("Stopped training after max epochs")
 
+        trees_per_second = len(X) * len(losses) / (time.time() - start_time)
+        self.__log(f"Trained on {trees_per_second:.0f} trees/s")
+        self.__fit_stats = {"padding_waste": waste,
+                            "unbucketed_padding_waste": unsorted_waste,
+                            "trees_per_second": trees_per_second}
+
         ### MODIFICATION: Write the final loss to the communication file
         # This code goes at the very end of the fit() method.
         try:
@@ -195,7 +326,11 @@ class BaoRegression:
         except Exception as e:
             print(f"ERROR: Could not write final loss to {LOSS_FILE_PATH}. Error: {e}")
 
-    def predict(self, X):
+    def predict(self, X, return_embedding=False):
+        """
+        Predict the latency of plans X. If `return_embedding` is set, also
+        return their embeddings, one row per plan.
+        """
         if not isinstance(X, list):
             X = [X]
         X = [json.loads(x) if isinstance(x, str) else x for x in X]
@@ -203,9 +338,38 @@ class BaoRegression:
         X = self.__tree_transform.transform(X)
         
         self.__net.eval()
-        pred = self.__net(X).cpu().detach().numpy()
-        return self.__pipeline.inverse_transform(pred)
+        if len(X) <= PREDICT_BATCH_SIZE:
+            pred, embedding = self.__predict_batch(X, return_embedding)
+        else:
+            # predict trees of similar size together, so that batches
+            # are not mostly padding, and put the results back in order
+            order = np.argsort([len(x.features) for x in X], kind="stable")
+            results = [self.__predict_batch([X[i] for i in batch], return_embedding)
+                       for batch in np.array_split(
+                           order, -(-len(X) // PREDICT_BATCH_SIZE))]
+            pred = np.empty((len(X), 1), dtype=np.float32)
+            pred[order] = np.concatenate([p for p, _ in results])
+            if return_embedding:
+                embeddings = np.concatenate([e for _, e in results])
+                embedding = np.empty_like(embeddings)
+                embedding[order] = embeddings
+
+        if not return_embedding:
+            return self.__pipeline.inverse_transform(pred)
+        return self.__pipeline.inverse_transform(pred), embedding
+
+    def __predict_batch(self, X, return_embedding):
+        if not return_embedding:
+            return self.__net.predict(X).cpu().numpy(), None
+
+        pred, embedding = self.__net.predict(X, return_embedding=True)
+        return pred.cpu().numpy(), embedding.cpu().numpy()
 
     @property
     def fit_losses(self):
-        return self.__fit_losses
\ No newline at end of file
+        return self.__fit_losses
+
+    @property
+    def fit_stats(self):
+        """ Padding and throughput of the last fit. """
+        return self.__fit_stats
\ No newline at end of file
@@ -121,7 +121,7 @@ class BaoRegression(pl.LightningModule):
         # Determine input channels if not set
         if self.in_channels is None:
             sample_tree = X[0]
-            self.in_channels = sample_tree[0].shape[0]
+            self.in_channels = sample_tree.features.shape[1]
             self.net = net.BaoNet(self.in_channels)
             if CUDA:
                 self.net = self.net.cuda()
@@ -298,7 +298,7 @@ class BaoRegression(pl.LightningModule):
 
         # determine the initial number of channels
         for inp, _tar in dataset:
-            in_channels = inp[0][0].shape[0]
+            in_channels = inp[0].features.shape[1]
             break
 
         self.__log("Initial input channels:", in_channels)
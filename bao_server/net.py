@@ -1,26 +1,28 @@
+import os
+import numpy as np
+import torch
 import torch.nn as nn
 from TreeConvolution.tcnn import BinaryTreeConv, TreeLayerNorm
 from TreeConvolution.tcnn import TreeActivation, DynamicPooling
-from TreeConvolution.util import prepare_trees
+from TreeConvolution.util import prepare_flat_trees
 
-def left_child(x):
-    if len(x) != 3:
-        return None
-    return x[1]
+# index in BaoNet.tree_conv of the layer whose output is exposed as the
+# plan embedding: the pooling after the last TreeLayerNorm, which gives
+# one vector per plan, whatever its size.
+EMBEDDING_LAYER = 8
 
-def right_child(x):
-    if len(x) != 3:
-        return None
-    return x[2]
-
-def features(x):
-    return x[0]
+def _example_tree(in_channels):
+    # a join of two scans, to trace the network with
+    return (np.zeros((3, in_channels), dtype=np.float32),
+            np.array([2, 0, 0], dtype=np.int32),
+            np.array([3, 0, 0], dtype=np.int32))
 
 class BaoNet(nn.Module):
     def __init__(self, in_channels):
         super(BaoNet, self).__init__()
         self.__in_channels = in_channels
         self.__cuda = False
+        self.__frozen = None
 
         self.tree_conv = nn.Sequential(
             BinaryTreeConv(self.__in_channels, 256),
@@ -40,10 +42,57 @@ class BaoNet(nn.Module):
     def in_channels(self):
         return self.__in_channels
         
-    def forward(self, x):
-        trees = prepare_trees(x, features, left_child, right_child,
-                              cuda=self.__cuda)
-        return self.tree_conv(trees)
+    def forward(self, x, return_embedding=False):
+        # x is a list of FeatureTrees, or a batch already prepared from
+        # them (see `prepare`)
+        trees = x if isinstance(x, tuple) else prepare_flat_trees(x, cuda=self.__cuda)
+        if not return_embedding:
+            return self.tree_conv(trees)
+
+        # split the forward pass at the embedding layer and return its
+        # output (batch x channels) as well, one row per tree.
+        hidden = self.tree_conv[:EMBEDDING_LAYER + 1](trees)
+        return self.tree_conv[EMBEDDING_LAYER + 1:](hidden), hidden
+
+    def prepare(self, packed, idxs):
+        """
+        Prepare the trees at positions `idxs` of PackedTrees `packed` as
+        a batch for `forward`, on the network's device.
+        """
+        return packed.batch(idxs, cuda=self.__cuda)
+
+    def predict(self, x, return_embedding=False):
+        """
+        Like `forward`, but for inference only: runs without autograd, and
+        through the frozen graph (see `freeze`) if there is one.
+        """
+        with torch.inference_mode():
+            if return_embedding or self.__frozen is None:
+                return self.forward(x, return_embedding=return_embedding)
+            return self.__frozen(prepare_flat_trees(x, cuda=self.__cuda))
+
+    def freeze(self, cache_path=None):
+        """
+        Trace the network (in eval mode) into a frozen TorchScript graph,
+        which `predict` uses from then on. If `cache_path` exists, the
+        graph is loaded from there instead, otherwise it is saved there.
+        """
+        if cache_path is not None and os.path.exists(cache_path):
+            self.__frozen = torch.jit.load(cache_path)
+            return
+
+        self.eval()
+        example = prepare_flat_trees([_example_tree(self.__in_channels)],
+                                     cuda=self.__cuda)
+        with torch.no_grad():
+            traced = torch.jit.trace(self.tree_conv, (example,))
+        self.__frozen = torch.jit.freeze(traced)
+
+        if cache_path is not None:
+            try:
+                torch.jit.save(self.__frozen, cache_path)
+            except OSError as e:
+                print("Could not cache the frozen network at", cache_path, e)
 
     def cuda(self):
         self.__cuda = True
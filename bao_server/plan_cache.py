@@ -0,0 +1,81 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+def buffer_signature(buffers):
+    # bucket each buffer count by its power of two, so that small
+    # fluctuations in the buffer pool do not defeat the cache.
+    return sorted((name, int(count).bit_length())
+                  for name, count in buffers.items())
+
+class PlanCache:
+    """
+    An LRU cache of plan selections, keyed by a fingerprint of the arm
+    plans and a quantized signature of the buffer state. Entries are
+    only valid for the model that produced them; call `invalidate` when
+    the model is swapped.
+    """
+    def __init__(self, max_size):
+        self.__max_size = max_size
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__generation = 0
+        self.__hits = 0
+        self.__misses = 0
+
+    @staticmethod
+    def key(arms, buffers):
+        h = hashlib.blake2b(digest_size=16)
+        for arm in arms:
+            h.update(json.dumps(arm, separators=(",", ":")).encode("UTF-8"))
+            h.update(b"\n")
+        h.update(json.dumps(buffer_signature(buffers),
+                            separators=(",", ":")).encode("UTF-8"))
+        return h.digest()
+
+    @property
+    def generation(self):
+        """
+        Read this before reading the current model, and pass it to `put`,
+        so results computed by a model that was swapped out in the
+        meantime are dropped.
+        """
+        return self.__generation
+
+    def get(self, key):
+        with self.__lock:
+            value = self.__entries.get(key)
+            if value is None:
+                self.__misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        with self.__lock:
+            if generation != self.__generation:
+                return
+
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+
+    def stats(self):
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "size": len(self.__entries),
+                "capacity": self.__max_size,
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups else 0.0
+            }
@@ -4,6 +4,7 @@ import psycopg2
 import json
 
 import storage
+from baoctl import flush_rewards
 from common import BaoException
 from config import read_config
 
@@ -57,6 +58,7 @@ class ExperimentRunner:
         config = read_config()
         self.__pg_connect_str = config["PostgreSQLConnectString"]
         self.__max_query_time = int(config["MaxQueryTimeSeconds"]) * 1000
+        storage.set_plan_encoding(config.get("PlanEncoding", "json"))
 
     def __get_pg_cursor(self):
         try:
@@ -162,9 +164,8 @@ class ExperimentRunner:
                     # otherwise, the timeout was because we went past the
                     # reasonable query limit. We should record that experiene.
                     print("Query hit timeout, recording 2*timeout as the reward.")
-                    bao_plan["Buffers"] = bao_buffer
-                    storage.record_reward(bao_plan, 2 * self.__max_query_time,
-                                          pid)
+                    storage.record_reward(dict(bao_plan, Buffers=bao_buffer),
+                                          2 * self.__max_query_time, pid)
                     c.execute("rollback")
                 except psycopg2.OperationalError as e:
                     # this query caused the server to go down! give it a
@@ -172,20 +173,29 @@ class ExperimentRunner:
                     print("Server down after experiment with arm", arm_idx)
                     if arm_idx != 0:
                         print("Treating this as a timeout and ceasing further experiments.")
-                        bao_plan["Buffers"] = bao_buffer
-                        storage.record_reward(bao_plan, 2 * self.__max_query_time,
-                                              pid)
+                        storage.record_reward(dict(bao_plan, Buffers=bao_buffer),
+                                              2 * self.__max_query_time, pid)
                     raise BaoException(f"Server down after experiment with arm {arm_idx}") from e
 
+                # the server writes rewards to the DB in the background, so
+                # have it write out what it has before looking for ours.
                 retries_remaining = 5
-                while (last_id := storage.last_reward_from_pid(pid)) == prev_id:
-                    # wait a second to make sure the reward is flushed to the DB
-                    time.sleep(1)
+                while True:
+                    try:
+                        flush_rewards()
+                    except OSError as e:
+                        # retry as if the reward had not arrived yet
+                        print("Could not flush rewards on the Bao server:", e)
+                    if (last_id := storage.last_reward_from_pid(pid)) != prev_id:
+                        break
+
+                    # the reward may not have reached the server yet
                     retries_remaining -= 1
                     if retries_remaining <= 0:
                         raise BaoException(
                             "Reward for experiment did not appear after 5 seconds, "
                             + "is the Bao server running?")
+                    time.sleep(1)
 
                 # last_id is the ID of the experience for this experiment
                 storage.record_experiment(experiment_id, last_id, arm_idx)
@@ -0,0 +1,68 @@
+import queue
+import threading
+import time
+
+import storage
+
+class RewardWriter:
+    """
+    Records rewards from a background thread, grouping the inserts of
+    many rewards into a single transaction. A batch is written once
+    `batch_size` rewards are waiting or `flush_interval_ms` after the
+    first of them arrived, whichever comes first. At most `max_pending`
+    rewards are buffered; beyond that, `record` blocks.
+    """
+    def __init__(self, flush_interval_ms=100, batch_size=256, max_pending=8192):
+        self.__interval = flush_interval_ms / 1000.0
+        self.__batch_size = batch_size
+        self.__queue = queue.Queue(maxsize=max_pending)
+
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="bao-reward-writer",
+                                         daemon=True)
+        self.__thread.start()
+
+    def record(self, plan, reward, pid):
+        self.__queue.put((plan, reward, pid))
+
+    def flush(self):
+        """
+        Block until every reward recorded before this call has been
+        committed.
+        """
+        barrier = threading.Event()
+        self.__queue.put(barrier)
+        barrier.wait()
+
+    def __next_batch(self):
+        item = self.__queue.get()
+        rewards = []
+
+        # the first reward opens the window; a flush closes it early.
+        deadline = time.monotonic() + self.__interval
+        while not isinstance(item, threading.Event):
+            rewards.append(item)
+            remaining = deadline - time.monotonic()
+            if len(rewards) >= self.__batch_size or remaining <= 0:
+                return rewards, None
+            try:
+                item = self.__queue.get(timeout=remaining)
+            except queue.Empty:
+                return rewards, None
+
+        return rewards, item
+
+    def __run(self):
+        while True:
+            rewards, barrier = self.__next_batch()
+
+            if rewards:
+                try:
+                    storage.record_rewards(rewards)
+                    print("Logged", len(rewards), "reward(s)")
+                except Exception as e:
+                    print("Failed to record", len(rewards), "reward(s):", e)
+
+            if barrier is not None:
+                barrier.set()
+
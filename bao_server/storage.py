@@ -1,25 +1,32 @@
 import sqlite3
+import hashlib
 import json
+import math
+import random
+import statistics
+import zlib
 import itertools
+import threading
 
 from common import BaoException
+from plan_cache import buffer_signature
 
-def _bao_db():
-    conn = sqlite3.connect("bao.db")
-    c = conn.cursor()
-    c.execute("""
+DB_PATH = "bao.db"
+
+_SCHEMA = [
+    """
 CREATE TABLE IF NOT EXISTS experience (
     id INTEGER PRIMARY KEY,
     pg_pid INTEGER,
     plan TEXT, 
     reward REAL
-)""")
-    c.execute("""
+)""",
+    """
 CREATE TABLE IF NOT EXISTS experimental_query (
     id INTEGER PRIMARY KEY, 
     query TEXT UNIQUE
-)""")
-    c.execute("""
+)""",
+    """
 CREATE TABLE IF NOT EXISTS experience_for_experimental (
     experience_id INTEGER,
     experimental_id INTEGER,
@@ -27,18 +34,165 @@ CREATE TABLE IF NOT EXISTS experience_for_experimental (
     FOREIGN KEY (experience_id) REFERENCES experience(id),
     FOREIGN KEY (experimental_id) REFERENCES experimental_query(id),
     PRIMARY KEY (experience_id, experimental_id, arm_idx)
-)""")
-    conn.commit()
+)""",
+    """
+CREATE TABLE IF NOT EXISTS experience_features (
+    experience_id INTEGER PRIMARY KEY,
+    version INTEGER,
+    features BLOB,
+    FOREIGN KEY (experience_id) REFERENCES experience(id)
+)""",
+    # for last_reward_from_pid, which the experiment runner polls
+    """
+CREATE INDEX IF NOT EXISTS experience_pid_idx ON experience (pg_pid, id)
+""",
+    # the retention policy (see `enforce_retention`): the experience that
+    # left the window and was kept as part of its template's sample, ...
+    """
+CREATE TABLE IF NOT EXISTS experience_reservoir (
+    experience_id INTEGER PRIMARY KEY,
+    template TEXT,
+    FOREIGN KEY (experience_id) REFERENCES experience(id)
+)""",
+    """
+CREATE INDEX IF NOT EXISTS experience_reservoir_template_idx
+ON experience_reservoir (template)
+""",
+    # ... how much experience of each template has left the window, ...
+    """
+CREATE TABLE IF NOT EXISTS experience_template (
+    template TEXT PRIMARY KEY,
+    seen INTEGER
+)""",
+    # ... and the newest experience that has been through the window.
+    """
+CREATE TABLE IF NOT EXISTS retention_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    retired_up_to INTEGER
+)""",
+    # the rewards of each distinct plan (see `update_plan_summaries`),
+    # along with the newest experience that has this plan ...
+    """
+CREATE TABLE IF NOT EXISTS plan_summary (
+    fingerprint TEXT PRIMARY KEY,
+    experience_id INTEGER,
+    count INTEGER,
+    mean REAL,
+    m2 REAL,
+    min REAL,
+    median REAL,
+    log_mean REAL,
+    recent_rewards TEXT,
+    FOREIGN KEY (experience_id) REFERENCES experience(id)
+)""",
+    """
+CREATE INDEX IF NOT EXISTS plan_summary_experience_idx
+ON plan_summary (experience_id)
+""",
+    # ... and the newest experience included in the summaries.
+    """
+CREATE TABLE IF NOT EXISTS plan_summary_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    summarized_up_to INTEGER
+)""",
+    # the plan fingerprint of each summarized experience, to find the
+    # experience a summary falls back to when the retention policy drops
+    # the one it refers to.
+    """
+CREATE TABLE IF NOT EXISTS experience_fingerprint (
+    experience_id INTEGER PRIMARY KEY,
+    fingerprint TEXT,
+    FOREIGN KEY (experience_id) REFERENCES experience(id)
+)""",
+    """
+CREATE INDEX IF NOT EXISTS experience_fingerprint_idx
+ON experience_fingerprint (fingerprint, experience_id)
+"""
+]
+
+# each thread keeps one open connection to bao.db, and sqlite3 keeps the
+# compiled statements of each connection, so repeated calls only bind
+# parameters and step.
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def _init_schema(conn):
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        # WAL lets readers (training, the experiment runner) proceed
+        # while the server is writing rewards. It is a property of the
+        # database file, so it only needs to be set once.
+        conn.execute("PRAGMA journal_mode=WAL")
+        for stmt in _SCHEMA:
+            conn.execute(stmt)
+        conn.commit()
+        _schema_ready = True
+
+def _bao_db():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        return conn
+
+    conn = sqlite3.connect(DB_PATH, cached_statements=256)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA mmap_size=268435456")
+    _init_schema(conn)
+    _local.conn = conn
     return conn
 
+# number of experience rows fetched from the database at a time when
+# streaming the experience table.
+EXPERIENCE_BATCH_SIZE = 1000
+
+# how new plans are written to the experience table: "json" stores the
+# plan JSON as TEXT, "zlib" stores it compressed as a BLOB. Rows of either
+# encoding can be read back at any time, see `_decode_plan`.
+PLAN_ENCODINGS = ("json", "zlib")
+_plan_encoding = "json"
+
+def set_plan_encoding(encoding):
+    global _plan_encoding
+    if encoding not in PLAN_ENCODINGS:
+        raise BaoException(f"Unknown plan encoding {encoding}, "
+                           + f"expected one of {', '.join(PLAN_ENCODINGS)}")
+    _plan_encoding = encoding
+
+def _encode_plan(plan, encoding=None):
+    encoding = encoding or _plan_encoding
+    if encoding == "zlib":
+        return zlib.compress(json.dumps(plan, separators=(",", ":")).encode("UTF-8"))
+    return json.dumps(plan)
+
+def _decode_plan(stored):
+    """ Returns the plan JSON of a stored plan, whatever its encoding. """
+    if isinstance(stored, bytes):
+        return zlib.decompress(stored).decode("UTF-8")
+    return stored
+
 def record_reward(plan, reward, pid):
     with _bao_db() as conn:
         c = conn.cursor()
         c.execute("INSERT INTO experience (plan, reward, pg_pid) VALUES (?, ?, ?)",
-                  (json.dumps(plan), reward, pid))
+                  (_encode_plan(plan), reward, pid))
         conn.commit()
 
     print("Logged reward of", reward)
+    _maybe_enforce_retention(1)
+
+def record_rewards(rewards):
+    """
+    Records a batch of (plan, reward, pid) tuples in a single transaction.
+    """
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.executemany("INSERT INTO experience (plan, reward, pg_pid) VALUES (?, ?, ?)",
+                      ((_encode_plan(plan), reward, pid) for plan, reward, pid in rewards))
+        conn.commit()
+
+    _maybe_enforce_retention(len(rewards))
 
 def last_reward_from_pid(pid):
     with _bao_db() as conn:
@@ -50,19 +204,45 @@ def last_reward_from_pid(pid):
             return None
         return res[0][0]
 
+def iter_experience(batch_size=EXPERIENCE_BATCH_SIZE):
+    """
+    Stream the (plan, reward, id) of every experience, fetching
+    `batch_size` rows from the database at a time.
+    """
+    c = _bao_db().cursor()
+    c.execute("SELECT plan, reward, id FROM experience ORDER BY id")
+    while rows := c.fetchmany(batch_size):
+        for plan, reward, exp_id in rows:
+            yield _decode_plan(plan), reward, exp_id
+
 def experience():
+    return list(iter_experience())
+
+def sample_experience(n):
+    """
+    Returns the plans of up to `n` random experience rows.
+    """
     with _bao_db() as conn:
         c = conn.cursor()
-        c.execute("SELECT plan, reward FROM experience")
-        return c.fetchall()
+        c.execute("SELECT plan FROM experience ORDER BY RANDOM() LIMIT ?", (n,))
+        return [json.loads(_decode_plan(x[0])) for x in c.fetchall()]
 
 def experiment_experience():
     all_experiment_experience = []
     for res in experiment_results():
         all_experiment_experience.extend(
-            [(x["plan"], x["reward"]) for x in res]
+            [(x["plan"], x["reward"], x["id"]) for x in res]
         )
     return all_experiment_experience
+
+def record_features(version, features):
+    """ Cache the serialized featurization of each (experience id, bytes) pair. """
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.executemany("""
+INSERT OR REPLACE INTO experience_features (experience_id, version, features)
+VALUES (?, ?, ?)""", ((exp_id, version, f) for exp_id, f in features))
+        conn.commit()
     
 def experience_size():
     with _bao_db() as conn:
@@ -70,9 +250,345 @@ def experience_size():
         c.execute("SELECT count(*) FROM experience")
         return c.fetchone()[0]
 
+def migrate_plans(encoding, batch_size=1000):
+    """
+    Re-encode every stored plan that is not already in `encoding`, then
+    compact the database. Returns the number of plans rewritten.
+    """
+    if encoding not in PLAN_ENCODINGS:
+        raise BaoException(f"Unknown plan encoding {encoding}, "
+                           + f"expected one of {', '.join(PLAN_ENCODINGS)}")
+    stored_type = "blob" if encoding == "zlib" else "text"
+
+    conn = _bao_db()
+    migrated = 0
+    last_id = -1
+    while True:
+        with conn:
+            c = conn.cursor()
+            c.execute("""
+SELECT id, plan FROM experience
+WHERE id > ? AND typeof(plan) != ?
+ORDER BY id LIMIT ?""", (last_id, stored_type, batch_size))
+            rows = c.fetchall()
+            if not rows:
+                break
+
+            c.executemany("UPDATE experience SET plan = ? WHERE id = ?",
+                          ((_encode_plan(json.loads(_decode_plan(plan)), encoding), exp_id)
+                           for exp_id, plan in rows))
+            migrated += len(rows)
+            last_id = rows[-1][0]
+
+    # give the space freed by the old encoding back to the filesystem.
+    conn.execute("VACUUM")
+    return migrated
+
+# the retention policy, see `set_retention_policy`.
+_retention_window = 0
+_retention_per_template = 0
+_retention_max_rows = 0
+_rows_since_retention = 0
+
+# how many rewards are recorded between two runs of the retention policy.
+RETENTION_INTERVAL = 1000
+
+def set_retention_policy(window=0, per_template=0, max_rows=0):
+    """
+    Bound the experience table (0 disables each bound). The newest
+    `window` experiences are always kept. Older experience is kept only
+    as a uniform random sample of up to `per_template` experiences per
+    query template (reservoir sampling, over everything that ever left
+    the window). Finally, if there are more than `max_rows` experiences,
+    the oldest ones are dropped. Experience of experimental queries is
+    never dropped. The policy is applied every RETENTION_INTERVAL
+    recorded rewards.
+    """
+    global _retention_window, _retention_per_template, _retention_max_rows
+    _retention_window = window
+    _retention_per_template = per_template
+    _retention_max_rows = max_rows
+
+def _maybe_enforce_retention(num_recorded):
+    global _rows_since_retention
+    if not (_retention_window or _retention_max_rows):
+        return
+
+    _rows_since_retention += num_recorded
+    if _rows_since_retention >= RETENTION_INTERVAL:
+        _rows_since_retention = 0
+        enforce_retention()
+
+def _plan_template(plan):
+    """
+    Identifies the query template a plan belongs to by the relations (and
+    bitmap indexes) it reads, which do not depend on the arm used to plan
+    it or on the constants in the query.
+    """
+    relations = set()
+    stack = [plan["Plan"]]
+    while stack:
+        node = stack.pop()
+        if "Relation Name" in node:
+            relations.add(node["Relation Name"])
+        elif "Index Name" in node:
+            relations.add(node["Index Name"])
+        stack.extend(node.get("Plans", []))
+
+    return hashlib.blake2b("\n".join(sorted(relations)).encode("UTF-8"),
+                           digest_size=8).hexdigest()
+
+def _delete_experience(c, ids):
+    ids = [(x,) for x in ids]
+    c.executemany("DELETE FROM experience_features WHERE experience_id = ?", ids)
+    c.executemany("DELETE FROM experience_reservoir WHERE experience_id = ?", ids)
+    c.executemany("DELETE FROM experience_fingerprint WHERE experience_id = ?", ids)
+    c.executemany("DELETE FROM experience WHERE id = ?", ids)
+    # a summary moves to the newest experience of its plan that is left
+    # (e.g., one kept in its template's reservoir), so the plan is still
+    # trained on, and is dropped only along with the last of them.
+    c.executemany("""
+UPDATE plan_summary SET experience_id = (
+    SELECT max(f.experience_id) FROM experience_fingerprint f
+    WHERE f.fingerprint = plan_summary.fingerprint)
+WHERE experience_id = ?""", ids)
+    c.execute("DELETE FROM plan_summary WHERE experience_id IS NULL")
+
+def enforce_retention():
+    """
+    Apply the retention policy (see `set_retention_policy`) now. Returns
+    the number of experiences dropped.
+    """
+    conn = _bao_db()
+    dropped = 0
+    with conn:
+        c = conn.cursor()
+        if _retention_window > 0:
+            dropped += _retire_experience(c)
+
+        if _retention_max_rows > 0:
+            c.execute("SELECT count(*) FROM experience")
+            excess = c.fetchone()[0] - _retention_max_rows
+            if excess > 0:
+                c.execute("""
+SELECT id FROM experience
+WHERE id NOT IN (SELECT experience_id FROM experience_for_experimental)
+ORDER BY id LIMIT ?""", (excess,))
+                ids = [x[0] for x in c.fetchall()]
+                _delete_experience(c, ids)
+                dropped += len(ids)
+
+    if dropped:
+        print("Retention policy dropped", dropped, "experience(s)")
+    return dropped
+
+def _retire_experience(c):
+    # everything older than the newest `window` experiences leaves the
+    # window, once, and is offered to its template's reservoir.
+    c.execute("SELECT id FROM experience ORDER BY id DESC LIMIT 1 OFFSET ?",
+              (_retention_window - 1,))
+    row = c.fetchone()
+    if row is None:
+        return 0
+    boundary = row[0]
+
+    c.execute("SELECT retired_up_to FROM retention_state WHERE id = 0")
+    row = c.fetchone()
+    retired_up_to = row[0] if row else -1
+
+    # only the template of each plan is kept, in case a lot of
+    # experience leaves the window at once.
+    plans = c.connection.cursor()
+    plans.execute("""
+SELECT id, plan FROM experience
+WHERE id > ? AND id < ?
+  AND id NOT IN (SELECT experience_id FROM experience_for_experimental)
+ORDER BY id""", (retired_up_to, boundary))
+    retiring = []
+    while rows := plans.fetchmany(EXPERIENCE_BATCH_SIZE):
+        retiring.extend((exp_id, _plan_template(json.loads(_decode_plan(plan))))
+                        for exp_id, plan in rows)
+
+    dropped = []
+    if _retention_per_template <= 0:
+        dropped = [exp_id for exp_id, _template in retiring]
+    else:
+        for exp_id, template in retiring:
+            c.execute("SELECT seen FROM experience_template WHERE template = ?",
+                      (template,))
+            row = c.fetchone()
+            seen = (row[0] if row else 0) + 1
+            c.execute("INSERT OR REPLACE INTO experience_template (template, seen) "
+                      + "VALUES (?, ?)", (template, seen))
+
+            # the sample can hold fewer than k experiences even after
+            # more than k were seen, e.g., once the row limit dropped some
+            # of it; then the new experience just joins it.
+            c.execute("SELECT count(*) FROM experience_reservoir WHERE template = ?",
+                      (template,))
+            if c.fetchone()[0] >= _retention_per_template:
+                # keep the new experience with probability k / seen, in
+                # place of a random member of the sample.
+                if random.randrange(seen) >= _retention_per_template:
+                    dropped.append(exp_id)
+                    continue
+                c.execute("""
+SELECT experience_id FROM experience_reservoir
+WHERE template = ? ORDER BY RANDOM() LIMIT 1""", (template,))
+                evicted = c.fetchone()[0]
+                c.execute("DELETE FROM experience_reservoir WHERE experience_id = ?",
+                          (evicted,))
+                dropped.append(evicted)
+
+            c.execute("INSERT INTO experience_reservoir (experience_id, template) "
+                      + "VALUES (?, ?)", (exp_id, template))
+
+    _delete_experience(c, dropped)
+    c.execute("INSERT OR REPLACE INTO retention_state (id, retired_up_to) VALUES (0, ?)",
+              (boundary - 1,))
+    return len(dropped)
+
+# how many of the most recent rewards of each plan are kept to compute
+# the median reward.
+SUMMARY_MAX_REWARDS = 64
+
+def plan_fingerprint(plan):
+    """
+    Identifies plans that are the same for training purposes: the same
+    plan tree, with a buffer state that has the same coarse signature
+    (see `plan_cache.buffer_signature`).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps(plan["Plan"], sort_keys=True,
+                        separators=(",", ":")).encode("UTF-8"))
+    h.update(json.dumps(buffer_signature(plan.get("Buffers", {})),
+                        separators=(",", ":")).encode("UTF-8"))
+    return h.hexdigest()
+
+def update_plan_summaries(batch_size=EXPERIENCE_BATCH_SIZE):
+    """
+    Fold the experience recorded since the last call into the summary
+    of its plan: the number of times the plan was executed, the mean,
+    variance (Welford's m2), minimum and median of its rewards, and the
+    mean of the log of its rewards (the training target). Returns the
+    number of experiences summarized.
+    """
+    conn = _bao_db()
+    with conn:
+        c = conn.cursor()
+        c.execute("SELECT summarized_up_to FROM plan_summary_state WHERE id = 0")
+        row = c.fetchone()
+        summarized_up_to = row[0] if row else -1
+
+        # databases summarized before fingerprints were recorded
+        c.execute("SELECT 1 FROM experience_fingerprint LIMIT 1")
+        if summarized_up_to >= 0 and c.fetchone() is None:
+            _record_fingerprints(conn, summarized_up_to, batch_size)
+
+        summaries = {}
+        fingerprints = []
+        rows = conn.cursor()
+        rows.execute("SELECT id, plan, reward FROM experience WHERE id > ? ORDER BY id",
+                     (summarized_up_to,))
+        num_rows = 0
+        while batch := rows.fetchmany(batch_size):
+            for exp_id, plan, reward in batch:
+                fingerprint = plan_fingerprint(json.loads(_decode_plan(plan)))
+                fingerprints.append((exp_id, fingerprint))
+                summary = summaries.get(fingerprint)
+                if summary is None:
+                    c.execute("""
+SELECT count, mean, m2, min, log_mean, recent_rewards
+FROM plan_summary WHERE fingerprint = ?""", (fingerprint,))
+                    row = c.fetchone()
+                    if row is None:
+                        summary = [0, 0.0, 0.0, math.inf, 0.0, [], None]
+                    else:
+                        summary = list(row[:5]) + [json.loads(row[5]), None]
+
+                count, mean, m2, min_reward, log_mean, recent, _exp_id = summary
+                count += 1
+                delta = reward - mean
+                mean += delta / count
+                m2 += delta * (reward - mean)
+                log_mean += (math.log1p(reward) - log_mean) / count
+                recent = (recent + [reward])[-SUMMARY_MAX_REWARDS:]
+                summaries[fingerprint] = [count, mean, m2, min(min_reward, reward),
+                                          log_mean, recent, exp_id]
+                summarized_up_to = exp_id
+                num_rows += 1
+
+        c.executemany("""
+INSERT OR REPLACE INTO plan_summary
+(fingerprint, experience_id, count, mean, m2, min, median, log_mean, recent_rewards)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", (
+    (fingerprint, exp_id, count, mean, m2, min_reward,
+     statistics.median(recent), log_mean, json.dumps(recent))
+    for fingerprint, (count, mean, m2, min_reward, log_mean, recent, exp_id)
+    in summaries.items()))
+        c.executemany("INSERT OR REPLACE INTO experience_fingerprint "
+                      + "(experience_id, fingerprint) VALUES (?, ?)", fingerprints)
+        c.execute("INSERT OR REPLACE INTO plan_summary_state (id, summarized_up_to) "
+                  + "VALUES (0, ?)", (summarized_up_to,))
+    return num_rows
+
+def _record_fingerprints(conn, up_to, batch_size):
+    rows = conn.cursor()
+    rows.execute("SELECT id, plan FROM experience WHERE id <= ? ORDER BY id", (up_to,))
+    while batch := rows.fetchmany(batch_size):
+        conn.executemany(
+            "INSERT OR REPLACE INTO experience_fingerprint (experience_id, fingerprint) "
+            + "VALUES (?, ?)",
+            ((exp_id, plan_fingerprint(json.loads(_decode_plan(plan))))
+             for exp_id, plan in batch))
+
+def plan_summaries():
+    """
+    Returns a dict with the count, mean, variance, min and median reward
+    of each summarized plan, keyed by plan fingerprint.
+    """
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT fingerprint, experience_id, count, mean, m2, min, median FROM plan_summary""")
+        return {x[0]: {"experience_id": x[1], "count": x[2], "mean": x[3],
+                       "variance": x[4] / (x[2] - 1) if x[2] > 1 else 0.0,
+                       "min": x[5], "median": x[6]}
+                for x in c.fetchall()}
+
+def iter_plan_summary_features(version, batch_size=EXPERIENCE_BATCH_SIZE):
+    """
+    Stream the (id, fingerprint, log mean reward, count, features, plan)
+    of each summarized plan, fetching `batch_size` rows at a time. `id` is
+    the newest experience with the plan, and `features` its cached
+    featurization written with `version`; only if there is none, `plan`
+    holds the plan (otherwise it is None, and the plan is never read).
+    """
+    c = _bao_db().cursor()
+    c.execute("""
+SELECT s.experience_id, s.fingerprint, s.log_mean, s.count, f.features,
+       CASE WHEN f.features IS NULL THEN e.plan END
+FROM plan_summary s
+JOIN experience e ON e.id = s.experience_id
+LEFT OUTER JOIN experience_features f
+     ON f.experience_id = e.id AND f.version = ?
+ORDER BY s.experience_id""", (version,))
+    while rows := c.fetchmany(batch_size):
+        for exp_id, fingerprint, log_mean, count, features, plan in rows:
+            if plan is not None:
+                plan = _decode_plan(plan)
+            yield exp_id, fingerprint, log_mean, count, features, plan
+
 def clear_experience():
     with _bao_db() as conn:
         c = conn.cursor()
+        c.execute("DELETE FROM plan_summary")
+        c.execute("DELETE FROM plan_summary_state")
+        c.execute("DELETE FROM experience_fingerprint")
+        c.execute("DELETE FROM experience_features")
+        c.execute("DELETE FROM experience_reservoir")
+        c.execute("DELETE FROM experience_template")
+        c.execute("DELETE FROM retention_state")
         c.execute("DELETE FROM experience")
         conn.commit()
 
@@ -98,10 +614,10 @@ def num_experimental_queries():
 def unexecuted_experiments():
     with _bao_db() as conn:
         c = conn.cursor()
-        c.execute("CREATE TEMP TABLE arms (arm_idx INTEGER)")
-        c.execute("INSERT INTO arms (arm_idx) VALUES (0),(1),(2),(3),(4)")
-
+        # connections are reused, so the arms are a CTE rather than a
+        # temporary table.
         c.execute("""
+WITH arms (arm_idx) AS (VALUES (0),(1),(2),(3),(4))
 SELECT eq.id, eq.query, arms.arm_idx 
 FROM experimental_query eq, arms
 LEFT OUTER JOIN experience_for_experimental efe 
@@ -115,7 +631,7 @@ def experiment_results():
     with _bao_db() as conn:
         c = conn.cursor()
         c.execute("""
-SELECT eq.id, e.reward, e.plan, efe.arm_idx
+SELECT eq.id, e.reward, e.plan, efe.arm_idx, e.id
 FROM experimental_query eq, 
      experience_for_experimental efe, 
      experience e 
@@ -123,7 +639,8 @@ WHERE eq.id = efe.experimental_id AND e.id = efe.experience_id
 ORDER BY eq.id, efe.arm_idx;
 """)
         for eq_id, grp in itertools.groupby(c, key=lambda x: x[0]):
-            yield ({"reward": x[1], "plan": x[2], "arm": x[3]} for x in grp)
+            yield ({"reward": x[1], "plan": _decode_plan(x[2]), "arm": x[3], "id": x[4]}
+                   for x in grp)
         
 
 def record_experiment(experimental_id, experience_id, arm_idx):
@@ -0,0 +1,63 @@
+import pickle
+import random
+import unittest
+
+from featurize import TreeBuilder, TreeBuilderError
+
+IMDB_RELATIONS = ["aka_name", "aka_title", "cast_info", "char_name",
+                  "company_name", "company_type", "info_type", "keyword",
+                  "movie_companies", "movie_info", "movie_info_idx",
+                  "movie_keyword", "name", "title"]
+
+def _substring_scan(relations, index_name):
+    # the lookup before the trie: the first (longest) relation name that
+    # appears in the index name.
+    for rel in sorted(relations, key=lambda x: len(x), reverse=True):
+        if rel in index_name:
+            return rel
+    return None
+
+def _match(builder, index_name):
+    return builder._TreeBuilder__match_relation(index_name)
+
+class TestTreeBuilder(unittest.TestCase):
+
+    def test_trie_matches_substring_scan(self):
+        builder = TreeBuilder(None, IMDB_RELATIONS)
+        for index_name in ["movie_info_idx_movie_id", "movie_info_movie_id",
+                           "title_pkey", "name_pkey", "aka_name_person_id",
+                           "info_type_pkey", "company_name_idx", "unknown_idx",
+                           ""]:
+            self.assertEqual(_match(builder, index_name),
+                             _substring_scan(IMDB_RELATIONS, index_name),
+                             index_name)
+
+    def test_trie_matches_substring_scan_randomized(self):
+        # a small alphabet, so names overlap, nest and tie in length
+        rng = random.Random(0)
+        for _ in range(200):
+            relations = list({"".join(rng.choice("abc") for _ in range(rng.randint(1, 4)))
+                              for _ in range(rng.randint(1, 8))})
+            builder = TreeBuilder(None, relations)
+            for _ in range(20):
+                index_name = "".join(rng.choice("abcd")
+                                     for _ in range(rng.randint(0, 10)))
+                self.assertEqual(_match(builder, index_name),
+                                 _substring_scan(relations, index_name),
+                                 (relations, index_name))
+
+    def test_unknown_index_raises(self):
+        builder = TreeBuilder(None, IMDB_RELATIONS)
+        with self.assertRaises(TreeBuilderError):
+            builder.resolve_index_names(["unknown_idx"])
+
+    def test_trie_is_rebuilt_after_pickling(self):
+        builder = TreeBuilder(None, IMDB_RELATIONS)
+        builder.resolve_index_names(["title_pkey"])
+        builder = pickle.loads(pickle.dumps(builder))
+        self.assertNotIn("_TreeBuilder__trie", builder.__dict__)
+        self.assertEqual(_match(builder, "movie_keyword_idx"), "movie_keyword")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+import numpy as np
+
+from inference_batcher import InferenceBatcher
+
+class BlockingModel:
+    """ Predicts each plan as itself, after the first call is released. """
+    def __init__(self):
+        self.batch_sizes = []
+        self.release = threading.Event()
+
+    def predict(self, plans):
+        self.release.wait()
+        self.batch_sizes.append(len(plans))
+        return np.array(plans, dtype=np.float64).reshape(-1, 1)
+
+class FailingModel(BlockingModel):
+    """ Like BlockingModel, but fails on any batch with a negative plan. """
+    def predict(self, plans):
+        res = super().predict(plans)
+        if min(plans) < 0:
+            raise ValueError("cannot featurize plan")
+        return res
+
+class TestInferenceBatcher(unittest.TestCase):
+
+    def test_batches_hold_at_most_max_plans(self):
+        batcher = InferenceBatcher(window_ms=1, max_plans=4)
+        model = BlockingModel()
+        results = {}
+
+        def request(i, num_plans):
+            plans = list(range(10 * i, 10 * i + num_plans))
+            results[i] = (plans, batcher.predict(model, plans))
+
+        # the first request blocks the model, so the others pile up, more
+        # than max_plans of them.
+        threads = [threading.Thread(target=request, args=(0, 1))]
+        threads[0].start()
+        time.sleep(0.05)
+        for i, num_plans in enumerate([1, 2, 3, 1, 1, 2, 1], start=1):
+            threads.append(threading.Thread(target=request, args=(i, num_plans)))
+            threads[-1].start()
+        time.sleep(0.05)
+
+        model.release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(sum(model.batch_sizes), 12)
+        self.assertLessEqual(max(model.batch_sizes), 4)
+        self.assertGreater(len(model.batch_sizes), 3)
+        for plans, res in results.values():
+            np.testing.assert_array_equal(res.flatten(), plans)
+
+    def test_oversized_request_is_not_split(self):
+        batcher = InferenceBatcher(window_ms=1, max_plans=4)
+        model = BlockingModel()
+        model.release.set()
+        res = batcher.predict(model, list(range(6)))
+        self.assertEqual(model.batch_sizes, [6])
+        np.testing.assert_array_equal(res.flatten(), np.arange(6))
+
+
+    def test_failure_only_fails_its_own_request(self):
+        batcher = InferenceBatcher(window_ms=1, max_plans=16)
+        model = FailingModel()
+        results = {}
+
+        def request(i, plans):
+            try:
+                results[i] = batcher.predict(model, plans)
+            except ValueError as e:
+                results[i] = e
+
+        # the blocked first request lets the other three share a batch
+        requests = {0: [0], 1: [1, 2], 2: [-1], 3: [3]}
+        threads = [threading.Thread(target=request, args=(0, requests[0]))]
+        threads[0].start()
+        time.sleep(0.05)
+        for i in (1, 2, 3):
+            threads.append(threading.Thread(target=request, args=(i, requests[i])))
+            threads[-1].start()
+        time.sleep(0.05)
+
+        model.release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertIn(4, model.batch_sizes)
+        self.assertIsInstance(results[2], ValueError)
+        for i in (0, 1, 3):
+            np.testing.assert_array_equal(results[i].flatten(), requests[i])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+import main
+import model
+import storage
+
+def _plan(i):
+    return {"Plan": {"Node Type": "Hash Join", "Total Cost": 100.0 * i,
+                     "Plan Rows": 10 * i, "Plans": [
+                         {"Node Type": "Seq Scan", "Relation Name": "title",
+                          "Total Cost": 10.0 * i, "Plan Rows": i},
+                         {"Node Type": "Seq Scan", "Relation Name": "name",
+                          "Total Cost": 20.0 * i, "Plan Rows": 2 * i}]}}
+
+class TestBaoModel(unittest.TestCase):
+
+    def setUp(self):
+        # BaoModel writes its analysis directory to the working directory
+        self.__cwd = os.getcwd()
+        self.__dir = tempfile.mkdtemp(prefix="bao-main-test-")
+        os.chdir(self.__dir)
+        storage.DB_PATH = os.path.join(self.__dir, "bao.db")
+        storage._local = threading.local()
+        storage._schema_ready = False
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+        shutil.rmtree(self.__dir)
+
+    def test_failed_load_keeps_current_model(self):
+        torch.manual_seed(0)
+        buffers = {"title": 10, "name": 20}
+        reg = model.BaoRegression(have_cache_data=True)
+        reg.fit([dict(_plan(i), Buffers=buffers) for i in range(1, 21)],
+                np.arange(1, 21, dtype=np.float64), max_epochs=1)
+        reg.save("good_model")
+
+        bao_model = main.BaoModel()
+        self.assertTrue(bao_model.load_model("good_model").result())
+        before = bao_model.predict([_plan(3), buffers])
+        self.assertFalse(math.isnan(before))
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            future = bao_model.load_model("missing_model")
+            self.assertIsNotNone(future.exception())
+            # the failure is logged by a callback on the loader thread,
+            # which may still be running when the future resolves
+            deadline = time.monotonic() + 5
+            while ("Traceback" not in output.getvalue()
+                   and time.monotonic() < deadline):
+                time.sleep(0.01)
+        self.assertIn("Failed to load Bao model from missing_model, keeping the "
+                      + "current model", output.getvalue())
+        self.assertIn("Traceback", output.getvalue())
+        self.assertEqual(bao_model.predict([_plan(3), buffers]), before)
+
+
+    def test_unfeaturizable_warmup_plan_does_not_reject_model(self):
+        torch.manual_seed(0)
+        buffers = {"title": 10, "name": 20}
+        reg = model.BaoRegression(have_cache_data=True)
+        reg.fit([dict(_plan(i), Buffers=buffers) for i in range(1, 21)],
+                np.arange(1, 21, dtype=np.float64), max_epochs=1)
+        reg.save("good_model")
+
+        # a stored plan with a bitmap index the model cannot resolve
+        bad_plan = _plan(1)
+        bad_plan["Plan"]["Plans"][0] = {
+            "Node Type": "Bitmap Index Scan", "Index Name": "unknown_idx",
+            "Total Cost": 1.0, "Plan Rows": 1}
+        storage.record_rewards([(bad_plan, 1.0, 1)])
+
+        bao_model = main.BaoModel()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(bao_model.load_model("good_model").result())
+        self.assertFalse(math.isnan(bao_model.predict([_plan(3), buffers])))
+
+
+    def test_load_model_waits_when_asked(self):
+        torch.manual_seed(0)
+        buffers = {"title": 10, "name": 20}
+        reg = model.BaoRegression(have_cache_data=True)
+        reg.fit([dict(_plan(i), Buffers=buffers) for i in range(1, 21)],
+                np.arange(1, 21, dtype=np.float64), max_epochs=1)
+        reg.save("good_model")
+
+        bao_model = main.BaoModel()
+        replies = []
+        with contextlib.redirect_stdout(io.StringIO()), \
+             contextlib.redirect_stderr(io.StringIO()):
+            main.handle_messages(bao_model, [{"type": "load model", "wait": True},
+                                             {"path": "good_model"}],
+                                 replies.append)
+            # the model is in place as soon as the reply is sent
+            self.assertFalse(math.isnan(bao_model.predict([_plan(3), buffers])))
+
+            main.handle_messages(bao_model, [{"type": "load model", "wait": True},
+                                             {"path": "missing_model"}],
+                                 replies.append)
+        self.assertEqual([json.loads(x) for x in replies],
+                         [{"accepted": True}, {"accepted": False}])
+
+class StatsModel:
+    """
+    Stands in for BaoModel: answers "cache stats" with a large reply,
+    slowly, from the executor thread.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.calls = 0
+
+    def cache_stats(self):
+        self.calls += 1
+        time.sleep(0.05)
+        return {"padding": "x" * self.size}
+
+def _exchange(bao_model, payload, limit=main.MAX_LINE_BYTES):
+    """
+    Serve one asyncio connection, send `payload` and close the sending
+    side, then return everything the server sent back.
+    """
+    async def run():
+        executor = ThreadPoolExecutor(max_workers=1)
+        server = await asyncio.start_server(
+            functools.partial(main.handle_connection, bao_model, executor),
+            "127.0.0.1", 0, limit=limit)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(payload)
+            writer.write_eof()
+            response = await asyncio.wait_for(reader.read(), 10)
+            writer.close()
+            return response
+        finally:
+            server.close()
+            await server.wait_closed()
+            executor.shutdown(wait=True)
+
+    return asyncio.run(run())
+
+class TestHandleConnection(unittest.TestCase):
+
+    def test_reply_is_sent_before_close(self):
+        # larger than the transport buffers, so the reply is only complete
+        # if it was written before the drain and close
+        bao_model = StatsModel(4 * 1024 * 1024)
+        response = _exchange(bao_model, b'{"type": "cache stats"}\n'
+                                       + b'{"final": true}\n')
+        self.assertEqual(bao_model.calls, 1)
+        self.assertTrue(response.endswith(b"\n"))
+        self.assertEqual(len(json.loads(response)["padding"]), bao_model.size)
+
+    def test_eof_mid_message(self):
+        bao_model = StatsModel(1)
+        response = _exchange(bao_model, b'{"type": "cache stats"}\n'
+                                       + b'{"final": tr')
+        self.assertEqual(response, b"")
+        self.assertEqual(bao_model.calls, 0)
+
+    def test_oversized_line(self):
+        bao_model = StatsModel(1)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            response = _exchange(bao_model,
+                                 b'{"type": "cache stats", "pad": "'
+                                 + b"x" * 4096 + b'"}\n{"final": true}\n',
+                                 limit=1024)
+        self.assertEqual(response, b"")
+        self.assertEqual(bao_model.calls, 0)
+        self.assertIn("exceeded", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
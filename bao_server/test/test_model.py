@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+import torch
+
+import model
+
+RELATIONS = ["title", "cast_info", "movie_info", "name"]
+
+def _plan(num_joins, i):
+    # a left-deep join of num_joins + 1 scans
+    def scan(j):
+        return {"Node Type": "Seq Scan", "Relation Name": RELATIONS[j % len(RELATIONS)],
+                "Total Cost": 10.0 * (i + j + 1), "Plan Rows": i + j + 1}
+
+    node = scan(0)
+    for j in range(num_joins):
+        node = {"Node Type": "Hash Join", "Total Cost": 100.0 * (i + j + 1),
+                "Plan Rows": 10 * (i + j + 1), "Plans": [node, scan(j + 1)]}
+    return {"Plan": node, "Buffers": {rel: 8 * i for rel in RELATIONS}}
+
+class TestBaoRegression(unittest.TestCase):
+
+    def test_predict_many_with_embeddings(self):
+        # more plans than fit in one forward pass, of mixed sizes, so
+        # they are predicted in several size-sorted batches
+        torch.manual_seed(0)
+        plans = [_plan(i % 12, i) for i in range(model.PREDICT_BATCH_SIZE + 100)]
+        reg = model.BaoRegression(have_cache_data=True)
+        reg.fit(plans[:50], np.arange(1, 51, dtype=np.float64), max_epochs=1)
+
+        pred, embedding = reg.predict(plans, return_embedding=True)
+        self.assertEqual(pred.shape, (len(plans), 1))
+        self.assertEqual(embedding.shape, (len(plans), 64))
+
+        # each result is back in the position of its plan
+        for i in (0, 7, 11, model.PREDICT_BATCH_SIZE + 99):
+            one_pred, one_embedding = reg.predict([plans[i]], return_embedding=True)
+            np.testing.assert_allclose(pred[i], one_pred[0], rtol=1e-4)
+            np.testing.assert_allclose(embedding[i], one_embedding[0],
+                                       rtol=1e-4, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
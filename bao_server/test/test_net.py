@@ -0,0 +1,76 @@
+import unittest
+import numpy as np
+import torch
+
+from featurize import FeatureTree
+import net
+
+def _random_tree(rng, num_scans, channels):
+    # a random binary tree over num_scans scans, in preorder
+    left = []
+    right = []
+
+    def build(n):
+        pos = len(left)
+        left.append(0)
+        right.append(0)
+        if n > 1:
+            k = int(rng.integers(1, n))
+            left[pos] = build(k)
+            right[pos] = build(n - k)
+        return pos + 1
+
+    build(num_scans)
+    return FeatureTree(rng.normal(size=(len(left), channels)).astype(np.float32),
+                       np.array(left), np.array(right))
+
+def _feature_trees(channels):
+    # a join of a join and a scan, and a join of two scans
+    rng = np.random.default_rng(0)
+    return [
+        FeatureTree(rng.normal(size=(5, channels)).astype(np.float32),
+                    np.array([2, 0, 4, 0, 0]), np.array([3, 0, 5, 0, 0])),
+        FeatureTree(rng.normal(size=(3, channels)).astype(np.float32),
+                    np.array([2, 0, 0]), np.array([3, 0, 0]))
+    ]
+
+class TestBaoNet(unittest.TestCase):
+
+    def test_embedding_independent_of_batch(self):
+        torch.manual_seed(0)
+        bao_net = net.BaoNet(6)
+        bao_net.eval()
+        large, small = _feature_trees(6)
+
+        pred_alone, alone = bao_net.predict([small], return_embedding=True)
+        pred_batched, batched = bao_net.predict([large, small],
+                                                return_embedding=True)
+
+        self.assertEqual(tuple(alone.shape), (1, 64))
+        self.assertEqual(tuple(batched.shape), (2, 64))
+        self.assertTrue(torch.allclose(alone[0], batched[1], atol=1e-5))
+        self.assertTrue(torch.allclose(pred_alone[0], pred_batched[1], atol=1e-5))
+
+
+    def test_frozen_matches_eager(self):
+        # the network is traced on one small tree, but must handle any
+        # batch size and tree shape
+        torch.manual_seed(0)
+        rng = np.random.default_rng(0)
+        bao_net = net.BaoNet(6)
+        bao_net.eval()
+        batches = [[_random_tree(rng, int(rng.integers(1, 12)), 6)
+                    for _ in range(size)]
+                   for size in (1, 2, 5, 16, 40)]
+        with torch.no_grad():
+            eager = [bao_net(batch) for batch in batches]
+
+        bao_net.freeze()
+        for batch, expected in zip(batches, eager):
+            frozen = bao_net.predict(batch)
+            self.assertEqual(frozen.shape, expected.shape)
+            self.assertTrue(torch.allclose(frozen, expected, atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
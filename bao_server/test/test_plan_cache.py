@@ -0,0 +1,73 @@
+import unittest
+
+from plan_cache import PlanCache, buffer_signature
+
+def _arms(i):
+    return [{"Plan": {"Node Type": "Seq Scan", "Relation Name": "title",
+                      "Total Cost": float(i)}}]
+
+class TestPlanCache(unittest.TestCase):
+
+    def test_put_from_old_generation_is_dropped(self):
+        cache = PlanCache(4)
+        key = PlanCache.key(_arms(1), {"title": 10})
+
+        # a selection computed by the model that was swapped out meanwhile
+        generation = cache.generation
+        cache.invalidate()
+        cache.put(key, "stale", generation)
+        self.assertIsNone(cache.get(key))
+
+        cache.put(key, "fresh", cache.generation)
+        self.assertEqual(cache.get(key), "fresh")
+
+    def test_invalidate_clears_entries(self):
+        cache = PlanCache(4)
+        key = PlanCache.key(_arms(1), {"title": 10})
+        cache.put(key, "value", cache.generation)
+        cache.invalidate()
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_lru_eviction(self):
+        cache = PlanCache(2)
+        keys = [PlanCache.key(_arms(i), {"title": 10}) for i in range(3)]
+        cache.put(keys[0], 0, cache.generation)
+        cache.put(keys[1], 1, cache.generation)
+        # touching the oldest entry makes the other one least recently used
+        self.assertEqual(cache.get(keys[0]), 0)
+        cache.put(keys[2], 2, cache.generation)
+
+        self.assertEqual(cache.get(keys[0]), 0)
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.get(keys[2]), 2)
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_hit_miss_counters(self):
+        cache = PlanCache(4)
+        key = PlanCache.key(_arms(1), {"title": 10})
+        self.assertIsNone(cache.get(key))
+        cache.put(key, "value", cache.generation)
+        cache.get(key)
+        cache.get(key)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 2 / 3)
+        self.assertEqual(stats["capacity"], 4)
+        self.assertEqual(PlanCache(4).stats()["hit_rate"], 0.0)
+
+    def test_key_buckets_buffers(self):
+        # counts in the same power-of-two bucket share an entry
+        self.assertEqual(buffer_signature({"title": 9}),
+                         buffer_signature({"title": 15}))
+        self.assertEqual(PlanCache.key(_arms(1), {"title": 9}),
+                         PlanCache.key(_arms(1), {"title": 15}))
+        self.assertNotEqual(PlanCache.key(_arms(1), {"title": 9}),
+                            PlanCache.key(_arms(1), {"title": 16}))
+        self.assertNotEqual(PlanCache.key(_arms(1), {"title": 9}),
+                            PlanCache.key(_arms(2), {"title": 9}))
+
+
+if __name__ == '__main__':
+    unittest.main()
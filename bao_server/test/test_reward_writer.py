@@ -0,0 +1,79 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import storage
+from reward_writer import RewardWriter
+
+def _plan(i):
+    return {"Plan": {"Node Type": "Seq Scan", "Relation Name": "title",
+                     "Total Cost": float(i), "Plan Rows": 1}}
+
+class TestRewardWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.__dir = tempfile.mkdtemp(prefix="bao-rewards-test-")
+        storage.DB_PATH = os.path.join(self.__dir, "bao.db")
+        storage._local = threading.local()
+        storage._schema_ready = False
+
+    def tearDown(self):
+        shutil.rmtree(self.__dir)
+
+    def test_flush_waits_for_pending_rewards(self):
+        # the interval alone would hold the rewards back for a minute
+        writer = RewardWriter(flush_interval_ms=60000)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(5):
+                writer.record(_plan(i), float(i), i)
+            writer.flush()
+        self.assertEqual(storage.experience_size(), 5)
+
+        # with nothing pending, flush returns at once
+        with contextlib.redirect_stdout(io.StringIO()):
+            writer.flush()
+        self.assertEqual(storage.experience_size(), 5)
+
+    def test_rewards_are_written_in_batches(self):
+        with mock.patch.object(storage, "record_rewards",
+                               wraps=storage.record_rewards) as record, \
+             contextlib.redirect_stdout(io.StringIO()):
+            writer = RewardWriter(flush_interval_ms=60000, batch_size=3)
+            for i in range(7):
+                writer.record(_plan(i), float(i), i)
+            writer.flush()
+
+        self.assertEqual([len(call.args[0]) for call in record.call_args_list],
+                         [3, 3, 1])
+        self.assertEqual(sorted(r for _plan, r, _pid in storage.experience()),
+                         [float(i) for i in range(7)])
+
+    def test_interval_closes_a_batch(self):
+        written = threading.Event()
+        with mock.patch.object(storage, "record_rewards",
+                               side_effect=lambda rewards: written.set()), \
+             contextlib.redirect_stdout(io.StringIO()):
+            writer = RewardWriter(flush_interval_ms=10, batch_size=100)
+            writer.record(_plan(1), 1.0, 1)
+            # written without a flush once the window has passed
+            self.assertTrue(written.wait(5))
+            writer.flush()
+
+    def test_failed_write_releases_flush(self):
+        output = io.StringIO()
+        with mock.patch.object(storage, "record_rewards",
+                               side_effect=OSError("disk full")), \
+             contextlib.redirect_stdout(output):
+            writer = RewardWriter(flush_interval_ms=60000)
+            writer.record(_plan(1), 1.0, 1)
+            writer.flush()
+        self.assertIn("Failed to record 1 reward(s): disk full", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import storage
+
+def _plan(relation, cost):
+    return {"Plan": {"Node Type": "Seq Scan", "Relation Name": relation,
+                     "Total Cost": cost, "Plan Rows": 1}}
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        # a fresh database for each test
+        self.__dir = tempfile.mkdtemp(prefix="bao-storage-test-")
+        storage.DB_PATH = os.path.join(self.__dir, "bao.db")
+        storage._local = threading.local()
+        storage._schema_ready = False
+
+    def tearDown(self):
+        storage.set_retention_policy()
+        storage.set_plan_encoding("json")
+        storage._local.conn.close()
+        shutil.rmtree(self.__dir)
+
+    def __plan_types(self):
+        c = storage._bao_db().cursor()
+        c.execute("SELECT typeof(plan) FROM experience ORDER BY id")
+        return [x[0] for x in c.fetchall()]
+
+    def __reservoir_size(self):
+        c = storage._bao_db().cursor()
+        c.execute("SELECT count(*) FROM experience_reservoir")
+        return c.fetchone()[0]
+
+    def test_retention_refills_emptied_reservoir(self):
+        # fill the reservoir of a template, then let the row limit drop
+        # all of it, while its count of seen experience stays above k.
+        storage.set_retention_policy(window=1, per_template=2)
+        storage.record_rewards([(_plan("title", i), i, 1) for i in range(4)])
+        storage.enforce_retention()
+        self.assertEqual(self.__reservoir_size(), 2)
+
+        storage.set_retention_policy(window=1, per_template=2, max_rows=1)
+        storage.enforce_retention()
+        self.assertEqual(self.__reservoir_size(), 0)
+
+        # new experience leaving the window joins the emptied reservoir,
+        # even if it would otherwise have replaced a member of it.
+        storage.set_retention_policy(window=1, per_template=2)
+        storage.record_rewards([(_plan("title", i), i, 1) for i in range(4, 6)])
+        with mock.patch.object(storage.random, "randrange", return_value=0):
+            storage.enforce_retention()
+        self.assertEqual(self.__reservoir_size(), 2)
+        self.assertEqual(storage.experience_size(), 3)
+
+
+    def test_reservoir_plan_stays_in_training_set(self):
+        # a plan executed twice, then a plan of another template
+        storage.record_rewards([(_plan("title", 1), 1.0, 1),
+                                (_plan("title", 1), 2.0, 1),
+                                (_plan("name", 1), 3.0, 1)])
+        storage.update_plan_summaries()
+
+        # keep the first execution in the reservoir, drop the second,
+        # which the summary of the plan refers to
+        storage.set_retention_policy(window=1, per_template=1)
+        with mock.patch.object(storage.random, "randrange", return_value=1):
+            self.assertEqual(storage.enforce_retention(), 1)
+
+        training = {exp_id: count for exp_id, _fingerprint, _log_mean, count, _f, _p
+                    in storage.iter_plan_summary_features(0)}
+        self.assertEqual(training, {1: 2, 3: 1})
+
+        # and once the last execution of a plan is gone, so is its summary
+        storage.set_retention_policy(max_rows=1)
+        storage.enforce_retention()
+        self.assertEqual(list(storage.plan_summaries()), [
+            storage.plan_fingerprint(_plan("name", 1))])
+
+
+    def test_migrate_plans_round_trip(self):
+        plans = [_plan("title", i) for i in range(5)]
+        storage.record_rewards([(p, float(i), 1) for i, p in enumerate(plans)])
+        expected = storage.experience()
+        self.assertEqual(self.__plan_types(), ["text"] * 5)
+
+        # small batches, so the migration takes several transactions
+        self.assertEqual(storage.migrate_plans("zlib", batch_size=2), 5)
+        self.assertEqual(self.__plan_types(), ["blob"] * 5)
+        self.assertEqual([(json.loads(p), r, i) for p, r, i in storage.experience()],
+                         [(json.loads(p), r, i) for p, r, i in expected])
+        # already migrated
+        self.assertEqual(storage.migrate_plans("zlib"), 0)
+
+        self.assertEqual(storage.migrate_plans("json", batch_size=2), 5)
+        self.assertEqual(self.__plan_types(), ["text"] * 5)
+        self.assertEqual([(json.loads(p), r, i) for p, r, i in storage.experience()],
+                         [(json.loads(p), r, i) for p, r, i in expected])
+
+    def test_mixed_encodings_read_back(self):
+        storage.record_rewards([(_plan("title", 1), 1.0, 1)])
+        storage.set_plan_encoding("zlib")
+        storage.record_rewards([(_plan("name", 2), 2.0, 1)])
+        self.assertEqual(self.__plan_types(), ["text", "blob"])
+
+        self.assertEqual([(json.loads(p), r) for p, r, _id in storage.experience()],
+                         [(_plan("title", 1), 1.0), (_plan("name", 2), 2.0)])
+        self.assertCountEqual(storage.sample_experience(2),
+                              [_plan("title", 1), _plan("name", 2)])
+
+        # only the plan in the other encoding is rewritten
+        self.assertEqual(storage.migrate_plans("zlib"), 1)
+        self.assertEqual(self.__plan_types(), ["blob", "blob"])
+
+
+if __name__ == '__main__':
+    unittest.main()
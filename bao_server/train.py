@@ -2,13 +2,28 @@ import storage
 # import model_lightning as model
 import model
 import os
+import pickle
 import shutil
 import reg_blocker
 import json
+import featurize
 from datetime import datetime
 import time
+import random
 import numpy as np
 
+# When warm starting, fall back to training from scratch if the new
+# experience falls further than this outside of the deployed model's
+# normalization ranges (as a fraction of the width of each range).
+WARM_START_MAX_DRIFT = 0.1
+
+# When warm starting, fine-tune on the new experience plus up to this
+# many times as much randomly sampled older experience.
+WARM_START_OLD_SAMPLE_RATIO = 2
+
+# When warm starting, the maximum number of epochs to fine-tune for.
+WARM_START_MAX_EPOCHS = 25
+
 class BaoTrainingException(Exception):
     pass
 
@@ -66,7 +81,8 @@ def archive_model(model_path, archive_dir="model_archive"):
     
     return archive_path
 
-def train_and_swap(fn, old, tmp, verbose=False):
+def train_and_swap(fn, old, tmp, verbose=False, warm_start=False,
+                   batch_size=storage.EXPERIENCE_BATCH_SIZE):
     old_metadata = get_training_metadata(fn)
     if os.path.exists(fn):
         old_model = model.BaoRegression(have_cache_data=True)
@@ -76,7 +92,10 @@ def train_and_swap(fn, old, tmp, verbose=False):
 
     # Train new model
     try:
-        new_model, training_metrics = train_and_save_model(tmp, verbose=verbose)
+        new_model, training_metrics = train_and_save_model(
+            tmp, verbose=verbose,
+            warm_start=old_model if warm_start else None,
+            batch_size=batch_size)
     except Exception as e:
         print(f"Error during training: {str(e)}")
         raise
@@ -101,7 +120,8 @@ def train_and_swap(fn, old, tmp, verbose=False):
         print("Retry #", current_retry)
         try:
             new_model, training_metrics = train_and_save_model(tmp, verbose=verbose,
-                                            emphasize_experiments=current_retry)
+                                            emphasize_experiments=current_retry,
+                                            batch_size=batch_size)
             metadata['retry_attempts'] = current_retry
             current_retry += 1
         except Exception as e:
@@ -130,43 +150,153 @@ def train_and_swap(fn, old, tmp, verbose=False):
         print(f"Error saving new model: {str(e)}")
         raise
 
-def train_and_save_model(fn, verbose=True, emphasize_experiments=0):
-    all_experience = storage.experience()
+def load_experience(batch_size=storage.EXPERIENCE_BATCH_SIZE):
+    """
+    Summarize the new experience, then stream the summary of each distinct
+    plan. Returns the extracted plans, their mean reward (the geometric
+    mean, which is what the model is fit to), the number of times each was
+    executed (to use as its weight), the id of the newest experience and
+    fingerprint of each plan, and the number of plans that had to be
+    extracted. Extractions are cached in the database, so only plans added
+    since the last training run are parsed, and no more than `batch_size`
+    plans are held as JSON at any time.
+    """
+    storage.update_plan_summaries(batch_size)
+
+    raws = []
+    rewards = []
+    weights = []
+    ids = []
+    fingerprints = []
+    new_features = []
+    num_new = 0
+
+    for exp_id, fingerprint, log_mean, count, features, plan in \
+            storage.iter_plan_summary_features(featurize.RAW_PLAN_VERSION, batch_size):
+        if features is not None:
+            raw = pickle.loads(features)
+        else:
+            raw = featurize.extract_plan(json.loads(plan))
+            new_features.append((exp_id, pickle.dumps(raw)))
+
+        raws.append(raw)
+        rewards.append(np.expm1(log_mean))
+        weights.append(count)
+        ids.append(exp_id)
+        fingerprints.append(fingerprint)
+
+        if len(new_features) >= batch_size:
+            storage.record_features(featurize.RAW_PLAN_VERSION, new_features)
+            num_new += len(new_features)
+            new_features = []
+
+    if new_features:
+        storage.record_features(featurize.RAW_PLAN_VERSION, new_features)
+        num_new += len(new_features)
+    return raws, rewards, weights, ids, fingerprints, num_new
+
+def select_warm_start_data(old_model, ids, x, y, weights):
+    """
+    Pick the data to fine-tune `old_model` on: all experience newer than
+    what it was trained on, plus a random sample of older experience.
+    Returns None if the model should be trained from scratch instead.
+    """
+    last_id = old_model.last_experience_id()
+    if last_id is None:
+        print("Deployed model does not record its training experience, "
+              + "training from scratch.")
+        return None
+
+    new_idxs = [i for i, exp_id in enumerate(ids) if exp_id > last_id]
+    old_idxs = [i for i, exp_id in enumerate(ids) if exp_id <= last_id]
+    if not new_idxs:
+        print("No new experience since the deployed model, training from scratch.")
+        return None
+
+    drift = old_model.normalization_drift([x[i] for i in new_idxs],
+                                          [y[i] for i in new_idxs])
+    if drift > WARM_START_MAX_DRIFT:
+        print(f"New experience drifted {drift:.3f} outside of the deployed model's "
+              + "normalization, training from scratch.")
+        return None
+
+    num_old = min(len(old_idxs), WARM_START_OLD_SAMPLE_RATIO * len(new_idxs))
+    idxs = new_idxs + random.sample(old_idxs, num_old)
+    print(f"Warm starting on {len(new_idxs)} new and {num_old} old experience(s).")
+    return [x[i] for i in idxs], [y[i] for i in idxs], [weights[i] for i in idxs]
+
+def train_and_save_model(fn, verbose=True, emphasize_experiments=0, warm_start=None,
+                         batch_size=storage.EXPERIENCE_BATCH_SIZE):
+    start_featurize_time = time.time()
+    x, y, weights, ids, fingerprints, num_extracted = load_experience(batch_size)
+    featurize_time = time.time() - start_featurize_time
+    if verbose:
+        print(f"Extracted {num_extracted} new plan(s), "
+              f"{len(x) - num_extracted} from cache, in {featurize_time:.2f}s, "
+              f"for {int(sum(weights))} experience(s)")
 
     start_data_time = time.time()
-    for _ in range(emphasize_experiments):
-        all_experience.extend(storage.experiment_experience())
+    if emphasize_experiments:
+        # experiments are also regular experience, so reuse the extraction
+        # of their plan, but with the reward of the experiment itself.
+        positions = {fingerprint: i for i, fingerprint in enumerate(fingerprints)}
+        experiments = []
+        for plan, reward, _exp_id in storage.experiment_experience():
+            i = positions.get(storage.plan_fingerprint(json.loads(plan)))
+            if i is not None:
+                experiments.append((i, reward))
+        for _ in range(emphasize_experiments):
+            for i, reward in experiments:
+                x.append(x[i])
+                y.append(reward)
+                weights.append(1)
+                ids.append(ids[i])
     data_collection_time = time.time() - start_data_time
     
-    x = [i[0] for i in all_experience]
-    y = [i[1] for i in all_experience]        
-    
-    if not all_experience:
+    if not x:
         raise BaoTrainingException("Cannot train a Bao model with no experience")
     
-    if len(all_experience) < 20:
+    if len(x) < 20:
         print("Warning: trying to train a Bao model with fewer than 20 datapoints.")
 
     reg = model.BaoRegression(have_cache_data=True, verbose=verbose)
 
+    warm_start_data = None
+    if warm_start is not None:
+        warm_start_data = select_warm_start_data(warm_start, ids, x, y, weights)
+
     start_train_time = time.time()
-    reg.fit(x, y)
+    if warm_start_data is not None:
+        fit_x, fit_y, fit_weights = warm_start_data
+        reg.fit(fit_x, fit_y, sample_weight=fit_weights, warm_start=warm_start,
+                max_epochs=WARM_START_MAX_EPOCHS)
+    else:
+        reg.fit(x, y, sample_weight=weights)
     training_time = time.time() - start_train_time
+    reg.set_last_experience_id(max(ids))
 
-    # Get predictions for metrics calculation
-    predictions = reg.predict(x)
+    # Get predictions for metrics calculation, a chunk at a time so that
+    # only one chunk is featurized at once
     y_true = np.array(y)
-    y_pred = np.array(predictions).flatten()
+    y_pred = np.concatenate([np.array(reg.predict(x[i:i + batch_size])).flatten()
+                             for i in range(0, len(x), batch_size)])
 
     # Convert metrics to JSON-serializable types
     metrics = {
         'training': {
             'samples': int(len(y_true)),  # Convert to Python int
+            'experiences': int(sum(weights)),
+            'warm_start': warm_start_data is not None,
             'epochs': int(len(reg.fit_losses)),
             'final_loss': reg.fit_losses[-1],
             'min_loss': min(reg.fit_losses),            
             'time_seconds': float(training_time),
+            'padding_waste': float(reg.fit_stats["padding_waste"]),
+            'unbucketed_padding_waste': float(reg.fit_stats["unbucketed_padding_waste"]),
+            'trees_per_second': float(reg.fit_stats["trees_per_second"]),
             'data_collection_time': float(data_collection_time),
+            'featurize_time': float(featurize_time),
+            'newly_extracted_plans': int(num_extracted),
         },
         'performance': {
             'mae': float(np.mean(np.abs(y_true - y_pred))),
@@ -185,8 +315,8 @@ def train_and_save_model(fn, verbose=True, emphasize_experiments=0):
         }
     }
     
-    # Store training data with the model for reference
-    reg.training_data = all_experience
+    # Store the ids of the training data with the model for reference
+    reg.training_data = ids
     reg.save(fn)
     
     return reg, metrics
@@ -363,6 +363,7 @@ BaoPlan* plan_query(Query *parse, int cursorOptions, ParamListInfo boundParams)
   BaoPlan* plan;
   PlannedStmt* plan_for_arm[BAO_MAX_ARMS];
   char* json_for_arm[BAO_MAX_ARMS];
+  char* start_json;
   Query* query_copy;
   int conn_fd;
 
@@ -392,7 +393,9 @@ BaoPlan* plan_query(Query *parse, int cursorOptions, ParamListInfo boundParams)
 
   memset(plan_for_arm, 0, BAO_MAX_ARMS*sizeof(PlannedStmt*));
 
-  write_all_to_socket(conn_fd, START_QUERY_MESSAGE);
+  start_json = query_start_json();
+  write_all_to_socket(conn_fd, start_json);
+  free(start_json);
   for (int i = 0; i < bao_num_arms; i++) {
     // Plan the query for this arm.
     query_copy = copyObject(parse);
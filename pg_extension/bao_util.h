@@ -14,7 +14,6 @@
 // Utility functions and common structs used throughout Bao.
 
 // JSON tags for sending to the Bao server.
-static const char* START_QUERY_MESSAGE = "{\"type\": \"query\"}\n";
 static const char *START_FEEDBACK_MESSAGE = "{\"type\": \"reward\"}\n";
 static const char* START_PREDICTION_MESSAGE = "{\"type\": \"predict\"}\n";
 static const char* TERMINAL_MESSAGE = "{\"final\": true}\n";
@@ -115,6 +114,23 @@ static char* reward_json(double reward) {
 
 }
 
+// Create the JSON object that starts a query message. It carries the PID of
+// this backend so that the Bao server can associate the selection (and its
+// embedding) with the session that planned the query.
+static char* query_start_json() {
+  char* buf;
+  size_t json_size;
+  FILE* stream;
+  pid_t pid = getpid();
+  
+  stream = open_memstream(&buf, &json_size);
+
+  fprintf(stream, "{\"type\": \"query\", \"pid\": %d}\n", pid);
+  fclose(stream);
+
+  return buf;
+}
+
 // Write the entire string to the given socket.
 static void write_all_to_socket(int conn_fd, const char* json) {
   size_t json_length;
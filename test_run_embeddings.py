@@ -2,9 +2,10 @@ import os
 import json
 import glob
 import shutil
+import socket
 import argparse
 import subprocess
-from time import time, sleep
+from time import sleep
 from datetime import datetime
 from tqdm import tqdm
 from sqlalchemy import create_engine, text
@@ -15,7 +16,6 @@ from sqlalchemy.pool import QueuePool
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 BAO_SERVER_DIR = os.path.join(SCRIPT_DIR, "bao_server")
 FINAL_MODEL_DIR = "/data/hdd1/users/kmparmp/experiment2/job/train/random/models/bao/random/final_model/20250520_141757_bao_default_model"
-TEMP_EMBEDDING_FILE = os.path.join(BAO_SERVER_DIR, "bao_last_embedding.tmp.json")
 
 # --- CONFIGURATION ---
 # Database connection string and server details
@@ -44,11 +44,18 @@ def get_alchemy_engine(db_name):
         )
     return engine
 
-def _load_json_safely(file_path):
-    if not os.path.exists(file_path): return None
+def fetch_embedding(pid):
+    """Fetches (and removes) the latest plan embedding of backend `pid` from the BAO server."""
     try:
-        with open(file_path, 'r') as f: return json.load(f)
-    except: return None
+        with socket.create_connection((BAO_HOST, BAO_PORT)) as s:
+            s.sendall((json.dumps({"type": "get embedding", "pid": pid}) + "\n").encode("UTF-8"))
+            s.sendall((json.dumps({"final": True}) + "\n").encode("UTF-8"))
+            s.shutdown(socket.SHUT_WR)
+            with s.makefile("rb") as f:
+                return json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        print(f"Could not fetch embedding from the BAO server: {e}")
+        return None
 
 # --- BAO SERVER MANAGEMENT ---
 
@@ -63,8 +70,6 @@ def kill_bao_server():
         shutil.rmtree(os.path.join(BAO_SERVER_DIR, "bao_default_model"), ignore_errors=True)
         if os.path.exists(os.path.join(BAO_SERVER_DIR, "bao.db")):
             os.remove(os.path.join(BAO_SERVER_DIR, "bao.db"))
-        if os.path.exists(TEMP_EMBEDDING_FILE):
-            os.remove(TEMP_EMBEDDING_FILE)
         
         # Run clean_experience.py using the correct CWD.
         subprocess.run(['python3', 'clean_experience.py'], cwd=BAO_SERVER_DIR, check=False)
@@ -109,18 +114,20 @@ def prepare_and_start_bao_server():
 
 def run_query_and_get_embedding(sql, db_name, bao_select=True, bao_num_arms=5):
     """
-    Runs a query, gets the plan, and reads the corresponding embedding from the temp file.
+    Runs a query, gets the plan, and fetches the corresponding embedding from the BAO server.
     Returns a dictionary with both the plan and the embedding data.
     """
     result_data = {}
     db_engine = get_alchemy_engine(db_name)
+    backend_pid = None
     
     try:
-        # Clear the temp file before running to avoid reading stale data
-        if os.path.exists(TEMP_EMBEDDING_FILE):
-            os.remove(TEMP_EMBEDDING_FILE)
-
         with db_engine.connect() as conn:
+            # The BAO server files embeddings under the PID of the backend that planned the query.
+            backend_pid = conn.execute(text("SELECT pg_backend_pid()")).scalar()
+            # Drop any embedding left over from an earlier query on this pooled connection.
+            fetch_embedding(backend_pid)
+
             conn.execute(text(f"""
                 SET enable_bao TO on;
                 SET bao_host = '{BAO_HOST}';
@@ -139,17 +146,10 @@ def run_query_and_get_embedding(sql, db_name, bao_select=True, bao_num_arms=5):
         print(f"An exception or timeout occurred: {e}")
         result_data['execution_plan'] = {'error': str(e)}
 
-    # --- ROBUST FILE WAITING LOGIC ---
+    # The server stores the embedding before replying to the planner, so it is ready by now.
     embedding_data = None
-    wait_timeout = 2.0  # Wait for a maximum of 2 seconds for the file to appear
-    start_wait = time()
-    while time() - start_wait < wait_timeout:
-        if os.path.exists(TEMP_EMBEDDING_FILE):
-            # Attempt to load it. It might be partially written.
-            embedding_data = _load_json_safely(TEMP_EMBEDDING_FILE)
-            if embedding_data: # If loading was successful, break the loop
-                break
-        sleep(0.05) # Check every 50ms
+    if backend_pid is not None:
+        embedding_data = fetch_embedding(backend_pid)
 
     result_data['embedding_data'] = embedding_data
     return result_data